@@ -1,3 +1,14 @@
-from channels.routing import ProtocolTypeRouter
+from channels.auth import AuthMiddlewareStack
+from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.security.websocket import AllowedHostsOriginValidator
 
-application = ProtocolTypeRouter({})
+import main.routing
+from main.asgi import get_asgi_application, lifespan
+
+application = ProtocolTypeRouter({
+    "http": get_asgi_application(),
+    "lifespan": lifespan,
+    "websocket": AllowedHostsOriginValidator(
+        AuthMiddlewareStack(URLRouter(main.routing.websocket_urlpatterns))
+    ),
+})
@@ -56,8 +56,51 @@ CHANNEL_LAYERS = {
         }
     }
 }
+
+# Deployments with several worker processes set CACHE_REDIS_URL, e.g.
+# redis://127.0.0.1:6379/1, so that invalidating the API list cache reaches
+# all of them. Without it, as in tests and the benchmark commands, each
+# process keeps its own in-memory cache.
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+if CACHE_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+        }
+    }
+else:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+# Shared by all chat consumers of a worker process, see main.redis_pool
+CHAT_REDIS_URL = "redis://localhost"
+CHAT_REDIS_POOL_MINSIZE = 1
+CHAT_REDIS_POOL_MAXSIZE = 20
+# Seconds without a heartbeat after which a chat participant is offline, and
+# seconds heartbeats are buffered before being written in one batch
+CHAT_PRESENCE_TIMEOUT = 10
+CHAT_PRESENCE_FLUSH_INTERVAL = 1
+# Chat messages are written in batches of up to CHAT_HISTORY_BATCH_SIZE at
+# most CHAT_HISTORY_FLUSH_INTERVAL seconds after being sent, and dropped
+# after CHAT_HISTORY_MAX_ATTEMPTS failed writes; the last
+# CHAT_HISTORY_REPLAY are sent to every new connection
+CHAT_HISTORY_BATCH_SIZE = 100
+CHAT_HISTORY_FLUSH_INTERVAL = 0.5
+CHAT_HISTORY_MAX_ATTEMPTS = 5
+CHAT_HISTORY_REPLAY = 50
+# Seconds a chat connection authorization is reused for the same user and order
+CHAT_AUTH_CACHE_TIMEOUT = 60
+# Frames a chat socket may have queued or unacknowledged by its client before
+# it is closed as too slow, and seconds over which joins and leaves are
+# merged into one presence update
+CHAT_OUTBOX_SIZE = 100
+CHAT_PRESENCE_COALESCE_DELAY = 0.5
+# Where customer chat assignments are kept, see main.assignment, and the most
+# chats assigned to one employee at a time; further chats wait in line
+CHAT_ASSIGNMENT_STORE = "main.assignment.RedisAssignmentStore"
+CHAT_ASSIGNMENT_MAX_ROOMS = 5
+
 MIDDLEWARE = [
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -67,6 +110,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'main.middlewares.basket_middleware',
 ]
+if DEBUG:
+    # The toolbar middleware is sync only. Under ASGI it pushes every
+    # request, async views included, through the thread pool.
+    MIDDLEWARE.insert(0, 'debug_toolbar.middleware.DebugToolbarMiddleware')
 
 REST_FRAMEWORK = {
 
@@ -167,6 +214,16 @@ STATIC_URL = '/static/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Rendered invoice PDFs, see main.invoices. Not under MEDIA_ROOT, which is
+# public. Bump the version when the invoice's stylesheets or images change.
+INVOICE_CACHE_DIR = os.path.join(BASE_DIR, 'invoice-cache')
+INVOICE_TEMPLATE_VERSION = 1
+# Long-lived processes rendering invoices, 0 to render in the web process;
+# seconds a request waits for one; static stylesheets applied to every PDF
+INVOICE_RENDER_WORKERS = 4
+INVOICE_RENDER_TIMEOUT = 10
+INVOICE_STYLESHEETS = ['css/bootstrap.min.css']
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -1,25 +1,58 @@
 import logging
-import tempfile
-from datetime import datetime, timedelta
+from concurrent.futures import TimeoutError
+from datetime import timedelta
 
 from django import forms
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
-from django.db.models import Avg, Count, Min, Sum
-from django.db.models.functions import TruncDay
-from django.http import HttpResponse
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Avg, Min, Sum
+from django.db.models.functions import Coalesce
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
-from django.template.loader import render_to_string
 from django.template.response import TemplateResponse
 from django.urls import path
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.html import format_html
-from weasyprint import HTML
 
-from . import models
+from . import invoices, models, rollups
 
 logger = logging.getLogger(__name__)
 
 
+class EstimatedCountPaginator(Paginator):
+    """Pages unfiltered changelists of large tables by the database's row
+    estimate instead of a COUNT(*) that reads the whole table. Only
+    PostgreSQL keeps an estimate; elsewhere, and below ``threshold`` rows,
+    the count is exact."""
+    threshold = 100000
+
+    def estimated_count(self):
+        queryset = self.object_list
+        if queryset.query.where or connections[queryset.db].vendor != "postgresql":
+            return None
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    @cached_property
+    def count(self):
+        estimate = self.estimated_count()
+        if estimate is not None and estimate >= self.threshold:
+            return estimate
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # Filtered pages would otherwise count the whole table again
+    show_full_result_count = False
+
+
 @admin.register(models.User)
 class UserAdmin(DjangoUserAdmin):
     fieldsets = (
@@ -64,7 +97,7 @@ class UserAdmin(DjangoUserAdmin):
     ordering = ('email',)
 
 
-class AddressAdmin(admin.ModelAdmin):
+class AddressAdmin(LargeTableAdmin):
     list_display = (
         "user",
         "name",
@@ -73,6 +106,7 @@ class AddressAdmin(admin.ModelAdmin):
         "city",
         "country",
     )
+    list_select_related = ("user",)
     readonly_fields = ("user",)
 
 
@@ -129,8 +163,9 @@ class ProductTagAdmin(admin.ModelAdmin):
 admin.site.register(models.ProductTag, ProductTagAdmin)
 
 
-class ProductImageAdmin(admin.ModelAdmin):
+class ProductImageAdmin(LargeTableAdmin):
     list_display = ('thumbnail_tag', 'product_name')
+    list_select_related = ('product',)
     readonly_fields = ('thumbnail',)
     search_fields = ('product__name',)
 
@@ -153,12 +188,32 @@ class BasketLineInline(admin.TabularInline):
 
 
 @admin.register(models.Basket)
-class BasketAdmin(admin.ModelAdmin):
+class BasketAdmin(LargeTableAdmin):
     list_display = ("id", "user", "status", "count")
     list_editable = ("status",)
     list_filter = ("status",)
+    list_select_related = ("user",)
     inlines = (BasketLineInline,)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            item_count=Coalesce(Sum("basketline__quantity"), 0))
+
+    def count(self, obj):
+        return obj.item_count
+    count.admin_order_field = "item_count"
+
+
+def download_invoices(modeladmin, request, queryset):
+    orders = queryset.order_by("id").prefetch_related("lines__product").iterator(chunk_size=100)
+    response = StreamingHttpResponse(
+        invoices.invoices_zip(orders, request.build_absolute_uri("/")), content_type="application/zip")
+    response["Content-Disposition"] = 'attachment; filename="invoices.zip"'
+    return response
+
+
+download_invoices.short_description = "Download invoices of selected orders"
+
 
 class OrderLineInline(admin.TabularInline):
     model = models.OrderLine
@@ -166,11 +221,13 @@ class OrderLineInline(admin.TabularInline):
 
 
 @admin.register(models.Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(LargeTableAdmin):
     list_display = ("id", "user", "status")
     list_editable = ("status",)
+    list_select_related = ("user",)
     list_filter = ("status", "shipping_country", "date_added")
     inlines = (OrderLineInline,)
+    actions = [download_invoices]
     fieldsets = (
         (None, {
             "fields": (("user", "status"))
@@ -205,12 +262,14 @@ class CentralOfficeOrderLineInline(admin.TabularInline):
     readonly_fields = ("product",)
 
 
-class CentralOfficeOrderAdmin(admin.ModelAdmin):
+class CentralOfficeOrderAdmin(LargeTableAdmin):
     list_display = ("id", "user", "status")
     list_editable = ("status",)
+    list_select_related = ("user",)
     readonly_fields = ("user",)
     list_filter = ("status", "shipping_country", "date_added")
     inlines = (CentralOfficeOrderLineInline,)
+    actions = [download_invoices]
     fieldsets = (
         ("Main", {"fields": ("user", "status")}),
         (
@@ -248,7 +307,7 @@ class DispatchersProductAdmin(ProductAdmin):
     autocomplete_fields = ()
 
 
-class DispatchersOrderAdmin(admin.ModelAdmin):
+class DispatchersOrderAdmin(LargeTableAdmin):
     list_display = ("id", "shipping_name", "date_added", "status",)
     list_filter = ("status", "shipping_country", "date_added")
     inlines = (CentralOfficeOrderLineInline,)
@@ -305,11 +364,9 @@ class ReportingColoredAdminSite(ColoredAdminSite):
         return my_urls + urls
 
     def orders_per_day(self, request):
-        starting_day = datetime.now() - timedelta(days=180)
-        order_data = (models.Order.objects.filter(
-            date_added__gt=starting_day).annotate(
-                day=TruncDay("date_added")
-        ).values("day").annotate(c=Count("id")))
+        starting_day = timezone.localdate() - timedelta(days=180)
+        order_data = (models.OrderDailyRollup.objects.filter(day__gt=starting_day)
+                      .values("day").annotate(c=Sum("orders")).filter(c__gt=0).order_by("day"))
 
         labels = [x["day"].strftime("%Y-%m-%d") for x in order_data]
         values = [x["c"] for x in order_data]
@@ -325,17 +382,9 @@ class ReportingColoredAdminSite(ColoredAdminSite):
         if request.method == "POST":
             form = PeriodSelectForm(request.POST)
             if form.is_valid():
-                days = form.cleaned_data["period"]
-                starting_day = datetime.now() - timedelta(days=days)
-
-                data = (models.OrderLine.objects.filter(order__date_added__gt=starting_day)
-                        .values("product__name")
-                        .annotate(c=Count("id"))
-                        )
-
-                logger.info("most_bought_products query: %s", data.query)
-                labels = [x["product__name"] for x in data]
-                values = [x["c"] for x in data]
+                data = rollups.top_products(form.cleaned_data["period"])
+                labels = [name for name, _ in data]
+                values = [count for _, count in data]
         else:
             form = PeriodSelectForm()
             labels = None
@@ -376,25 +425,21 @@ class InvoiceMixin:
         return my_urls + urls
 
     def invoice_for_order(self, request, order_id):
-        order = get_object_or_404(models.Order, pk=order_id)
+        order = get_object_or_404(models.Order.objects.prefetch_related("lines__product"), pk=order_id)
 
         if request.GET.get("format") == "pdf":
-            html_string = render_to_string("invoice.html", {"order": order})
-            html = HTML(string=html_string, base_url=request.build_absolute_uri())
-
-            result = html.write_pdf()
-
-            response = HttpResponse(content_type="application/pdf")
-            response["Content-Disposition"] = "inline; filename=invoice.pdf"
+            # The template only links to absolute paths, so every page of
+            # the site shares one base URL and the cached files
+            try:
+                invoice = invoices.open_invoice_pdf(order, request.build_absolute_uri("/"))
+            except TimeoutError:
+                logger.warning("Invoice for order %d is taking too long to render", order.id)
+                response = HttpResponse("The invoice is being rendered, please retry shortly.",
+                                        status=503, content_type="text/plain")
+                response["Retry-After"] = "5"
+                return response
+            response = FileResponse(invoice, content_type="application/pdf", filename="invoice.pdf")
             response["Content-Transfer-Encoding"] = "binary"
-
-            with tempfile.NamedTemporaryFile(delete=True) as output:
-                output.write(result)
-                output.flush()
-                output = open(output.name, "rb")
-                binary_pdf = output.read()
-                response.write(binary_pdf)
-
             return response
         return render(request, "invoice.html", {"order": order})
 
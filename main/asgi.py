@@ -0,0 +1,75 @@
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+
+from . import redis_pool
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """Django's ASGI handler, except that the body of a streaming response
+    is produced in the request's thread instead of in the event loop.
+
+    Django 4.1 iterates streaming responses inside the loop, so a generator
+    that queries the database fails with SynchronousOnlyOperation, and one
+    that blocks stalls every other connection of the worker.
+
+    Other responses go to Django's own send_response. That method has no
+    hook for the header encoding, so response_headers is a copy of it from
+    Django 4.1.13; compare it with django/core/handlers/asgi.py when
+    upgrading Django."""
+
+    @staticmethod
+    def response_headers(response):
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode("ascii")
+            if isinstance(value, str):
+                value = value.encode("latin1")
+            headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            headers.append((b"Set-Cookie", c.output(header="").encode("ascii").strip()))
+        return headers
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            await super().send_response(response, send)
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": self.response_headers(response),
+        })
+
+        # Each part is taken in the thread the view ran in, which holds the
+        # database connection that the iterator's queries belong to.
+        parts = iter(response)
+        next_part = sync_to_async(next, thread_sensitive=True)
+        while True:
+            part = await next_part(parts, None)
+            if part is None:
+                break
+            for chunk, _ in self.chunk_bytes(part):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+async def lifespan(scope, receive, send):
+    """Closes the worker's Redis pool when an ASGI server that speaks the
+    lifespan protocol, such as uvicorn, shuts down. Daphne sends no
+    lifespan events; its pool is closed along with the process."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await redis_pool.close_pool()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def get_asgi_application():
+    django.setup(set_prefix=False)
+    return StreamingASGIHandler()
@@ -0,0 +1,353 @@
+"""Routes incoming customer chats to the least loaded online employee.
+
+Employees are online while their lobby socket keeps sending heartbeats to
+the LOBBY presence room. A chat goes to the online employee with the fewest
+assigned rooms, below CHAT_ASSIGNMENT_MAX_ROOMS; when nobody has room left
+it waits, oldest first, for the next employee to free up or come online.
+When an employee goes offline their chats are handed to the others.
+
+A worker that dies never reports its customers leaving, so whenever an
+employee comes online the chats nobody has sent a heartbeat in for
+CHAT_PRESENCE_TIMEOUT seconds are dropped."""
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+from . import presence, redis_pool
+
+logger = logging.getLogger(__name__)
+
+LOBBY = presence.LOBBY
+
+
+def employee_group(employee_id):
+    return "customer-service-employee_%s" % employee_id
+
+
+def chat_group(order_id):
+    """The chat's channel layer group, which is also its presence room."""
+    return "customer-service_%s" % order_id
+
+
+class LocalAssignmentStore:
+    """Keeps assignments in this process. Only correct with a single
+    worker; used by the tests and the simulate_assignment and loadtest_chat
+    commands. ``online`` fixes who is online instead of reading the LOBBY
+    presence room, so that the store needs no Redis at all."""
+
+    def __init__(self, online=None):
+        self.rooms = {}
+        self.load = {}
+        self.waiting = {}
+        self.customers = {}
+        self.joined = {}
+        self.online = online
+
+    async def online_employees(self):
+        if self.online is None:
+            return await presence.members(LOBBY)
+        return list(self.online)
+
+    async def customer_joined(self, room, now):
+        """Counts a customer socket of ``room``. True for its first one."""
+        self.customers[room] = self.customers.get(room, 0) + 1
+        self.joined[room] = now
+        return self.customers[room] == 1
+
+    async def customer_left(self, room):
+        """Uncounts a customer socket of ``room``. True for its last one."""
+        self.customers[room] = self.customers.get(room, 0) - 1
+        if self.customers[room] > 0:
+            return False
+        del self.customers[room]
+        self.joined.pop(room, None)
+        return True
+
+    async def tracked_rooms(self):
+        """Returns every room with customers, an employee or a place in
+        line, with the time its latest customer socket opened, if known."""
+        rooms = dict.fromkeys([*self.rooms, *self.waiting])
+        rooms.update(self.joined)
+        return rooms
+
+    async def forget_room(self, room):
+        """Drops ``room``'s customer count and releases it, see release."""
+        self.customers.pop(room, None)
+        self.joined.pop(room, None)
+        return await self.release(room)
+
+    async def employee_left(self, employee):
+        """Takes every room away from ``employee`` and returns them."""
+        rooms = [room for room, assigned in self.rooms.items() if assigned == employee]
+        for room in rooms:
+            del self.rooms[room]
+        self.load.pop(employee, None)
+        return rooms
+
+    def choose(self, candidates, max_rooms):
+        loads = [(self.load.get(c, 0), c) for c in candidates if self.load.get(c, 0) < max_rooms]
+        return min(loads)[1] if loads else None
+
+    def take(self, room, employee):
+        self.waiting.pop(room, None)
+        self.rooms[room] = employee
+        self.load[employee] = self.load.get(employee, 0) + 1
+
+    def oldest_waiting(self):
+        return min(self.waiting, key=self.waiting.get) if self.waiting else None
+
+    async def assign(self, room, candidates, max_rooms, now):
+        if room in self.rooms:
+            return self.rooms[room]
+        employee = self.choose(candidates, max_rooms)
+        if employee is None:
+            self.waiting.setdefault(room, now)
+            return None
+        self.take(room, employee)
+        return employee
+
+    async def release(self, room):
+        """Ends ``room``'s assignment. Returns its employee and the waiting
+        room handed to them in its place, if any."""
+        self.waiting.pop(room, None)
+        employee = self.rooms.pop(room, None)
+        if employee is None:
+            return None, None
+        self.load[employee] -= 1
+        next_room = self.oldest_waiting()
+        if next_room is not None:
+            self.take(next_room, employee)
+        return employee, next_room
+
+    async def drain(self, employee, max_rooms):
+        """Hands waiting rooms to ``employee`` until they are full."""
+        rooms = []
+        while self.waiting and self.load.get(employee, 0) < max_rooms:
+            room = self.oldest_waiting()
+            self.take(room, employee)
+            rooms.append(room)
+        return rooms
+
+
+class RedisAssignmentStore:
+    """Keeps assignments in Redis, shared by every worker. Each operation
+    is one Lua script, so concurrent workers never double book."""
+
+    ROOMS_KEY = "assignment:rooms"
+    LOAD_KEY = "assignment:load"
+    WAITING_KEY = "assignment:waiting"
+    CUSTOMERS_KEY = "assignment:customers"
+    JOINED_KEY = "assignment:joined"
+
+    ASSIGN = """
+    local current = redis.call('HGET', KEYS[1], ARGV[1])
+    if current then return current end
+    local best, best_load = nil, nil
+    for i = 4, #ARGV do
+        local load = tonumber(redis.call('ZSCORE', KEYS[2], ARGV[i]) or '0')
+        if load < tonumber(ARGV[3]) and (best_load == nil or load < best_load) then
+            best, best_load = ARGV[i], load
+        end
+    end
+    if best then
+        redis.call('ZREM', KEYS[3], ARGV[1])
+        redis.call('HSET', KEYS[1], ARGV[1], best)
+        redis.call('ZINCRBY', KEYS[2], 1, best)
+        return best
+    end
+    redis.call('ZADD', KEYS[3], 'NX', ARGV[2], ARGV[1])
+    return false
+    """
+    RELEASE = """
+    redis.call('ZREM', KEYS[3], ARGV[1])
+    local employee = redis.call('HGET', KEYS[1], ARGV[1])
+    if not employee then return {} end
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('ZINCRBY', KEYS[2], -1, employee)
+    local waiting = redis.call('ZRANGE', KEYS[3], 0, 0)
+    if #waiting == 0 then return {employee} end
+    redis.call('ZREM', KEYS[3], waiting[1])
+    redis.call('HSET', KEYS[1], waiting[1], employee)
+    redis.call('ZINCRBY', KEYS[2], 1, employee)
+    return {employee, waiting[1]}
+    """
+    DRAIN = """
+    local rooms = {}
+    local load = tonumber(redis.call('ZSCORE', KEYS[2], ARGV[1]) or '0')
+    while load < tonumber(ARGV[2]) do
+        local waiting = redis.call('ZRANGE', KEYS[3], 0, 0)
+        if #waiting == 0 then break end
+        redis.call('ZREM', KEYS[3], waiting[1])
+        redis.call('HSET', KEYS[1], waiting[1], ARGV[1])
+        load = redis.call('ZINCRBY', KEYS[2], 1, ARGV[1])
+        load = tonumber(load)
+        table.insert(rooms, waiting[1])
+    end
+    return rooms
+    """
+    CUSTOMER_LEFT = """
+    local left = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+    if left > 0 then return 0 end
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return 1
+    """
+    FORGET_ROOM = """
+    redis.call('HDEL', KEYS[4], ARGV[1])
+    redis.call('HDEL', KEYS[5], ARGV[1])
+    """ + RELEASE
+    EMPLOYEE_LEFT = """
+    local rooms = {}
+    local assigned = redis.call('HGETALL', KEYS[1])
+    for i = 1, #assigned, 2 do
+        if assigned[i + 1] == ARGV[1] then
+            redis.call('HDEL', KEYS[1], assigned[i])
+            table.insert(rooms, assigned[i])
+        end
+    end
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    return rooms
+    """
+
+    @property
+    def keys(self):
+        return [self.ROOMS_KEY, self.LOAD_KEY, self.WAITING_KEY]
+
+    async def assign(self, room, candidates, max_rooms, now):
+        redis = await redis_pool.get_redis()
+        return await redis.eval(
+            self.ASSIGN, keys=self.keys, args=[room, now, max_rooms, *candidates], encoding="utf-8")
+
+    async def release(self, room):
+        redis = await redis_pool.get_redis()
+        result = await redis.eval(self.RELEASE, keys=self.keys, args=[room], encoding="utf-8")
+        return tuple(result) + (None,) * (2 - len(result))
+
+    async def drain(self, employee, max_rooms):
+        redis = await redis_pool.get_redis()
+        return await redis.eval(self.DRAIN, keys=self.keys, args=[employee, max_rooms], encoding="utf-8")
+
+    async def online_employees(self):
+        return await presence.members(LOBBY)
+
+    async def customer_joined(self, room, now):
+        redis = await redis_pool.get_redis()
+        pipe = redis.multi_exec()
+        joined = pipe.hincrby(self.CUSTOMERS_KEY, room, 1)
+        pipe.hset(self.JOINED_KEY, room, now)
+        await pipe.execute()
+        return await joined == 1
+
+    async def customer_left(self, room):
+        redis = await redis_pool.get_redis()
+        return bool(await redis.eval(
+            self.CUSTOMER_LEFT, keys=[self.CUSTOMERS_KEY, self.JOINED_KEY], args=[room]))
+
+    async def tracked_rooms(self):
+        redis = await redis_pool.get_redis()
+        pipe = redis.multi_exec()
+        pipe.hkeys(self.ROOMS_KEY, encoding="utf-8")
+        pipe.zrange(self.WAITING_KEY, encoding="utf-8")
+        pipe.hgetall(self.JOINED_KEY, encoding="utf-8")
+        assigned, waiting, joined = await pipe.execute()
+        rooms = dict.fromkeys([*assigned, *waiting])
+        rooms.update((room, float(now)) for room, now in joined.items())
+        return rooms
+
+    async def forget_room(self, room):
+        redis = await redis_pool.get_redis()
+        result = await redis.eval(
+            self.FORGET_ROOM, keys=self.keys + [self.CUSTOMERS_KEY, self.JOINED_KEY], args=[room],
+            encoding="utf-8")
+        return tuple(result) + (None,) * (2 - len(result))
+
+    async def employee_left(self, employee):
+        redis = await redis_pool.get_redis()
+        return await redis.eval(self.EMPLOYEE_LEFT, keys=self.keys, args=[employee], encoding="utf-8")
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = import_string(settings.CHAT_ASSIGNMENT_STORE)()
+    return _store
+
+
+async def notify(employee, room):
+    await get_channel_layer().group_send(employee_group(employee), {
+        "type": "chat_assigned",
+        "order_id": int(room),
+        "url": reverse("cs_chat", kwargs={"order_id": int(room)}),
+    })
+
+
+async def request_employee(order_id):
+    """Assigns a customer's chat to an employee and tells them. Returns the
+    employee id, or None if the chat has to wait."""
+    store = get_store()
+    candidates = await store.online_employees()
+    employee = await store.assign(
+        str(order_id), candidates, settings.CHAT_ASSIGNMENT_MAX_ROOMS, time.time())
+    if employee is not None:
+        await notify(employee, order_id)
+    else:
+        logger.info("No employee free for chat %s, queued", order_id)
+    return employee
+
+
+async def release_employee(order_id):
+    """Ends a chat's assignment and passes the freed slot to the chat that
+    waited longest."""
+    employee, next_room = await get_store().release(str(order_id))
+    if next_room is not None:
+        await notify(employee, next_room)
+
+
+async def customer_connected(order_id):
+    """Asks for an employee when the first customer socket of a chat opens,
+    counting sockets across every worker."""
+    if await get_store().customer_joined(str(order_id), time.time()):
+        await request_employee(order_id)
+
+
+async def customer_disconnected(order_id):
+    """Releases the chat's employee once its last customer socket closes."""
+    if await get_store().customer_left(str(order_id)):
+        await release_employee(order_id)
+
+
+async def employee_online(employee):
+    """Hands the chats waiting longest to an employee who just came online."""
+    await drop_abandoned_chats()
+    for room in await get_store().drain(str(employee), settings.CHAT_ASSIGNMENT_MAX_ROOMS):
+        await notify(employee, room)
+
+
+async def employee_offline(employee):
+    """Hands an employee's chats to the others, or puts them in line."""
+    for room in await get_store().employee_left(str(employee)):
+        await request_employee(room)
+
+
+async def drop_abandoned_chats(now=None):
+    """Drops the chats that nobody has sent a heartbeat in, as left behind
+    by a worker that died. Chats whose latest customer socket opened within
+    CHAT_PRESENCE_TIMEOUT may not have sent their first heartbeat yet."""
+    now = time.time() if now is None else now
+    store = get_store()
+    for room, joined in (await store.tracked_rooms()).items():
+        if joined is not None and joined > now - settings.CHAT_PRESENCE_TIMEOUT:
+            continue
+        if await presence.members(chat_group(room), now):
+            continue
+        logger.info("Dropping abandoned chat %s", room)
+        employee, next_room = await store.forget_room(room)
+        if next_room is not None:
+            await notify(employee, next_room)
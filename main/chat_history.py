@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import weakref
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+from django.utils import timezone
+
+from . import metrics, models
+
+logger = logging.getLogger(__name__)
+
+# Messages accepted by this worker and not yet written, oldest first, and
+# the batch currently being written.
+_pending = []
+_writing = []
+_flushers = weakref.WeakKeyDictionary()
+# Raised by a row that would fail the same way on every attempt
+UNWRITABLE_ERRORS = (IntegrityError, DataError, ValueError)
+
+
+def _schedule_flush(delay):
+    loop = asyncio.get_running_loop()
+    _flushers[loop] = loop.create_task(_flush_later(delay))
+
+
+def record_message(order_id, user, message):
+    """Queues ``message`` for the next batched write and returns it.
+
+    The write happens at most ``CHAT_HISTORY_FLUSH_INTERVAL`` seconds later,
+    or as soon as ``CHAT_HISTORY_BATCH_SIZE`` messages are waiting."""
+    chat_message = models.ChatMessage(
+        order_id=int(order_id),
+        user=user,
+        username=user.get_full_name()[:models.ChatMessage._meta.get_field("username").max_length],
+        message=message,
+        date_added=timezone.now(),
+    )
+    _pending.append(chat_message)
+
+    flusher = _flushers.get(asyncio.get_running_loop())
+    if len(_pending) >= settings.CHAT_HISTORY_BATCH_SIZE and not _writing:
+        _schedule_flush(0)
+    elif flusher is None or flusher.done():
+        _schedule_flush(settings.CHAT_HISTORY_FLUSH_INTERVAL)
+    return chat_message
+
+
+async def _flush_later(delay):
+    await asyncio.sleep(delay)
+    await flush()
+
+
+def _write(batch):
+    """Writes ``batch`` with one INSERT or, if that fails, row by row.
+    Returns the messages that could not be written with their errors."""
+    try:
+        with transaction.atomic():
+            models.ChatMessage.objects.bulk_create(batch)
+        return []
+    except Exception:
+        pass
+    failed = []
+    for chat_message in batch:
+        try:
+            with transaction.atomic():
+                models.ChatMessage.objects.bulk_create([chat_message])
+        except Exception as e:
+            failed.append((chat_message, e))
+    return failed
+
+
+async def flush():
+    """Writes the queued messages with one bulk INSERT and returns how many
+    were written. Does nothing while another batch is being written.
+
+    Messages that fail are put back for the next flush, up to
+    ``CHAT_HISTORY_MAX_ATTEMPTS`` times, and dropped at once if they can
+    never be written, so that one bad row does not hold up the others."""
+    if _writing or not _pending:
+        return 0
+    _writing[:] = _pending
+    del _pending[:len(_writing)]
+    batch = list(_writing)
+    try:
+        failed = await database_sync_to_async(_write)(batch)
+    except Exception as e:
+        failed = [(chat_message, e) for chat_message in batch]
+    finally:
+        _writing.clear()
+
+    retry = []
+    for chat_message, error in failed:
+        chat_message.write_attempts = getattr(chat_message, "write_attempts", 0) + 1
+        if isinstance(error, UNWRITABLE_ERRORS) or chat_message.write_attempts >= settings.CHAT_HISTORY_MAX_ATTEMPTS:
+            logger.error("Dropping a chat message for order %d: %r", chat_message.order_id, error)
+        else:
+            retry.append(chat_message)
+    if retry:
+        logger.warning("Could not write %d chat messages, retrying later", len(retry))
+        _pending[:0] = retry
+    if _pending:
+        _schedule_flush(settings.CHAT_HISTORY_FLUSH_INTERVAL)
+
+    written = len(batch) - len(failed)
+    metrics.chat_history_writes.inc(written)
+    return written
+
+
+def serialize(chat_message):
+    return {
+        "username": chat_message.username,
+        "message": chat_message.message,
+        "date_added": chat_message.date_added.isoformat(),
+    }
+
+
+def _latest(order_id, limit):
+    return list(
+        models.ChatMessage.objects.filter(order_id=order_id)
+        .only("username", "message", "date_added")
+        .order_by("-id")[:limit]
+    )
+
+
+async def recent_messages(order_id, limit):
+    """Returns the last ``limit`` messages of an order's chat, oldest first,
+    including those this worker has not written yet."""
+    order_id = int(order_id)
+    unwritten = [m for m in _writing + _pending if m.order_id == order_id][-limit:]
+    written = await database_sync_to_async(_latest)(order_id, limit)
+    # The batch being written can already be in the database.
+    unwritten_pks = {m.pk for m in unwritten if m.pk is not None}
+    messages = [m for m in reversed(written) if m.pk not in unwritten_pks] + unwritten
+    return [serialize(m) for m in messages[-limit:]]
@@ -1,38 +1,143 @@
+import asyncio
+import collections
 import logging
 
-import aioredis
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.core.cache import cache
 
-from . import models
+from . import assignment, chat_history, dashboard, metrics, models, presence, redis_pool
 
 logger = logging.getLogger(__name__)
 
+# Chat sockets open in this worker per room, to drop the per-room message
+# series of rooms nobody here is in any more
+room_sockets = collections.Counter()
+
+
+class Outbox:
+    """Frames waiting to be sent to one websocket.
+
+    A single writer task sends them, so channel layer handlers never wait on
+    a slow client. Each frame carries a ``seq`` number that the client
+    acknowledges once it has handled the frame. The server's send returns
+    as soon as the frame is handed to the transport, so only
+    acknowledgements show what the client has really received. At most
+    ``maxsize`` frames are held or sent but not yet acknowledged. Joins and
+    leaves are not queued one by one; they are netted per user and sent as
+    one chat_presence frame ``presence_delay`` seconds after the first of
+    them."""
+
+    def __init__(self, send_json, maxsize, presence_delay):
+        self.send_json = send_json
+        self.maxsize = maxsize
+        self.presence_delay = presence_delay
+        self.frames = collections.deque()
+        self.sent = 0
+        self.acknowledged = 0
+        self.presence = {}
+        self.presence_timer = None
+        self.closed = False
+        self.wakeup = asyncio.Event()
+        self.writer = asyncio.ensure_future(self.write())
+
+    @property
+    def backlog(self):
+        return len(self.frames) + self.sent - self.acknowledged
+
+    def put(self, frame):
+        """Queues ``frame``, returning False if the outbox is full."""
+        if self.backlog >= self.maxsize:
+            return False
+        self.frames.append(frame)
+        self.wakeup.set()
+        return True
+
+    def acknowledge(self, seq):
+        """Records that the client has handled every frame up to ``seq``."""
+        self.acknowledged = max(self.acknowledged, min(seq, self.sent))
+
+    def presence_changed(self, key, username, joined):
+        delta, _ = self.presence.get(key, (0, username))
+        delta += 1 if joined else -1
+        if delta:
+            self.presence[key] = (delta, username)
+        else:
+            self.presence.pop(key, None)
+        if self.presence_timer is None:
+            self.presence_timer = asyncio.get_running_loop().call_later(
+                self.presence_delay, self.queue_presence
+            )
+
+    def queue_presence(self):
+        self.presence_timer = None
+        joined = sorted(name for delta, name in self.presence.values() if delta > 0)
+        left = sorted(name for delta, name in self.presence.values() if delta < 0)
+        self.presence.clear()
+        if joined or left:
+            # One frame per delay at most, so it may exceed the bound
+            self.frames.append({"type": "chat_presence", "joined": joined, "left": left})
+            self.wakeup.set()
+
+    async def write(self):
+        try:
+            while True:
+                while self.frames:
+                    self.sent += 1
+                    await self.send_json(dict(self.frames.popleft(), seq=self.sent))
+                self.wakeup.clear()
+                await self.wakeup.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Could not write to chat socket")
+
+    def close(self):
+        self.closed = True
+        self.writer.cancel()
+        if self.presence_timer is not None:
+            self.presence_timer.cancel()
+
 
 class ChatConsumer(AsyncJsonWebsocketConsumer):
     EMPLOYEE = 2
     CLIENT = 1
+    # Application close code for clients that cannot keep up
+    SLOW_CONSUMER = 4008
+
+    async def group_send(self, event):
+        with metrics.chat_group_send_seconds.time():
+            await self.channel_layer.group_send(self.room_group_name, event)
 
     def get_user_type(self, user, order_id):
-        order = get_object_or_404(models.Order, pk=order_id)
-
-        if user.is_employee:
-            order.last_spoken_to = user
-            order.save()
-            return ChatConsumer.EMPLOYEE
-        elif order.user == user:
-            return ChatConsumer.CLIENT
-        else:
-            return None
+        """Decides who may join an order's chat, reading only the order's
+        owner. Decisions are cached for CHAT_AUTH_CACHE_TIMEOUT seconds so
+        that reconnect storms do not reach the database."""
+        key = "chat-auth:%s:%s" % (user.pk, order_id)
+        user_type = cache.get(key)
+        if user_type is None:
+            owner_id = models.Order.objects.filter(pk=order_id).values_list("user_id", flat=True).first()
+            if owner_id is None:
+                user_type = 0
+            elif user.is_employee:
+                user_type = ChatConsumer.EMPLOYEE
+            elif owner_id == user.pk:
+                user_type = ChatConsumer.CLIENT
+            else:
+                user_type = 0
+            cache.set(key, user_type, settings.CHAT_AUTH_CACHE_TIMEOUT)
+        return user_type or None
 
     async def connect(self):
         self.order_id = self.scope["url_route"]["kwargs"]["order_id"]
-        self.room_group_name = ("customer-service_%s" % self.order_id)
+        self.room_group_name = assignment.chat_group(self.order_id)
         authorized = False
 
         if self.scope["user"].is_anonymous:
+            metrics.chat_connects.inc(outcome="anonymous")
             await self.close()
+            return
 
         user_type = await database_sync_to_async(
             self.get_user_type
@@ -46,34 +151,64 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             authorized = True
         else:
             logger.info("Unauthorized connection from %s", self.scope["user"],)
+            metrics.chat_connects.inc(outcome="refused")
             await self.close()
 
         if authorized:
-            self.r_conn = await aioredis.create_redis(
-                "redis://localhost"
-            )
+            self.authorized = True
+            metrics.chat_connects.inc(outcome="accepted")
+            metrics.chat_connections.inc()
+            room_sockets[self.order_id] += 1
+            self.is_customer = user_type == ChatConsumer.CLIENT
+            self.lifetime = redis_pool.ConsumerLifetime(self)
             await self.channel_layer.group_add(
                 self.room_group_name, self.channel_name
             )
             await self.accept()
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_join",
-                    "username": self.scope["user"].get_full_name(),
-
-                },
+            self.outbox = Outbox(
+                self.send_json,
+                settings.CHAT_OUTBOX_SIZE,
+                settings.CHAT_PRESENCE_COALESCE_DELAY,
             )
+            await self.send_json({
+                "type": "chat_history",
+                "messages": await chat_history.recent_messages(
+                    self.order_id, settings.CHAT_HISTORY_REPLAY
+                ),
+            })
+            await self.group_send({
+                "type": "chat_join",
+                "email": self.scope["user"].email,
+                "username": self.scope["user"].get_full_name(),
+            })
+            if self.is_customer:
+                await self.update_assignment(assignment.customer_connected)
+
+    async def update_assignment(self, update):
+        try:
+            await update(self.order_id)
+        except Exception:
+            # The chat works without an assigned employee; any of them can
+            # still join it from the order.
+            logger.exception("Could not update employee assignment of chat %s", self.order_id)
 
     async def disconnect(self, close_code):
-        if not self.scope['user'].is_anonymous:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_leave",
-                    "username": self.scope["user"].get_full_name(),
-                },
-            )
+        if getattr(self, "authorized", False):
+            self.lifetime.close()
+            self.outbox.close()
+            metrics.chat_connections.dec()
+            metrics.chat_disconnects.inc(code=close_code)
+            room_sockets[self.order_id] -= 1
+            if room_sockets[self.order_id] <= 0:
+                del room_sockets[self.order_id]
+                metrics.chat_room_messages.remove(room=self.order_id)
+            if self.is_customer:
+                await self.update_assignment(assignment.customer_disconnected)
+            await self.group_send({
+                "type": "chat_leave",
+                "email": self.scope["user"].email,
+                "username": self.scope["user"].get_full_name(),
+            })
             logger.info("Closing chat stream for user %s", self.scope["user"],)
 
             await self.channel_layer.group_discard(
@@ -82,33 +217,95 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
 
     async def receive_json(self, content):
         typ = content.get("type")
+        metrics.chat_received.inc(type=typ if typ in ("message", "heartbeat", "ack") else "other")
 
         if typ == "message":
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "username": self.scope["user"].get_full_name(),
-                    "message": content["message"],
-                },
+            metrics.chat_room_messages.inc(room=self.order_id)
+            chat_history.record_message(
+                self.order_id, self.scope["user"], content["message"]
             )
+            await self.group_send({
+                "type": "chat_message",
+                "username": self.scope["user"].get_full_name(),
+                "message": content["message"],
+            })
 
         elif typ == "heartbeat":
-            await self.r_conn.setex(
-                "%s_%s"
-                % (
-                    self.room_group_name,
-                    self.scope["user"].email,
-                ),
-                10,  # expiration (in 10 seconds)
-                "1",  # dummy value
+            presence.record_heartbeat(
+                self.room_group_name, self.scope["user"].email
             )
 
+        elif typ == "ack" and isinstance(content.get("seq"), int):
+            self.outbox.acknowledge(content["seq"])
+
     async def chat_message(self, event):
-        await self.send_json(event)
+        if self.outbox.closed:
+            return
+        if not self.outbox.put(event):
+            logger.warning(
+                "Closing chat stream for %s, %d frames behind",
+                self.scope["user"], self.outbox.backlog,
+            )
+            self.outbox.close()
+            metrics.chat_slow_consumers.inc()
+            await self.close(code=ChatConsumer.SLOW_CONSUMER)
 
     async def chat_join(self, event):
-        await self.send_json(event)
+        self.outbox.presence_changed(event["email"], event["username"] or event["email"], joined=True)
 
     async def chat_leave(self, event):
+        self.outbox.presence_changed(event["email"], event["username"] or event["email"], joined=False)
+
+
+class OrderDashboardConsumer(AsyncJsonWebsocketConsumer):
+    """Pushes order and order line creations and status changes to the
+    staff order dashboard, so that it does not have to be reloaded."""
+
+    async def connect(self):
+        if not self.scope["user"].is_staff:
+            await self.close()
+            return
+        await self.channel_layer.group_add(dashboard.GROUP, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(dashboard.GROUP, self.channel_name)
+
+    async def order_updates(self, event):
+        await self.send_json(event)
+
+
+class EmployeeLobbyConsumer(AsyncJsonWebsocketConsumer):
+    """Keeps an employee online for chat assignment while open, and tells
+    them which customer chats they have been assigned."""
+
+    async def connect(self):
+        user = self.scope["user"]
+        if user.is_anonymous or not await database_sync_to_async(lambda: user.is_employee)():
+            await self.close()
+            return
+        self.employee = str(user.pk)
+        await self.channel_layer.group_add(assignment.employee_group(self.employee), self.channel_name)
+        await self.accept()
+        presence.record_heartbeat(assignment.LOBBY, self.employee)
+        # Written now rather than on the next flush, so that waiting chats
+        # and the next assignment see this employee straight away
+        await presence.flush()
+        await assignment.employee_online(self.employee)
+
+    async def disconnect(self, close_code):
+        if hasattr(self, "employee"):
+            await self.channel_layer.group_discard(
+                assignment.employee_group(self.employee), self.channel_name)
+            await presence.forget(assignment.LOBBY, self.employee)
+            try:
+                await assignment.employee_offline(self.employee)
+            except Exception:
+                logger.exception("Could not reassign the chats of employee %s", self.employee)
+
+    async def receive_json(self, content):
+        if content.get("type") == "heartbeat":
+            presence.record_heartbeat(assignment.LOBBY, self.employee)
+
+    async def chat_assigned(self, event):
         await self.send_json(event)
@@ -0,0 +1,49 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.utils import formats, timezone
+
+logger = logging.getLogger(__name__)
+
+GROUP = "order-dashboard"
+
+
+def order_update(instance, created=False):
+    """Describes a created or changed Order or OrderLine for dashboards."""
+    update = {
+        "model": instance._meta.model_name,
+        "id": instance.pk,
+        "status": instance.status,
+        "status_display": instance.get_status_display(),
+        "created": created,
+    }
+    if instance._meta.model_name == "orderline":
+        update["order"] = instance.order_id
+    else:
+        update["date_updated"] = formats.date_format(
+            timezone.template_localtime(instance.date_updated), "SHORT_DATETIME_FORMAT")
+    return update
+
+
+def orderline_status_updates(lines, status, status_display):
+    """The updates for (line id, order id) pairs moved to ``status`` in bulk."""
+    return [
+        {"model": "orderline", "id": line_id, "order": order_id, "status": status,
+         "status_display": status_display, "created": False}
+        for line_id, order_id in lines
+    ]
+
+
+def publish(updates):
+    """Sends ``updates`` to every subscribed dashboard in one message. Meant
+    to run from ``transaction.on_commit`` so that rolled back changes are
+    never shown."""
+    if not updates:
+        return
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            GROUP, {"type": "order.updates", "updates": updates})
+    except Exception as e:
+        # Dashboards catch up on their next reload; the write must not fail.
+        logger.warning("Could not publish %d order updates: %s", len(updates), e)
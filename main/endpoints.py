@@ -1,28 +1,334 @@
-from rest_framework import serializers, viewsets
+import hashlib
+import logging
+import time
+from datetime import timedelta
 
-from . import models
+import django_filters
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Count, F, Max
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import quote_etag
+from rest_framework import (generics, pagination, permissions, serializers,
+                            viewsets)
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
 
+from . import metrics, models, presence, redis_pool, renderers
+from .views import OrderFilter
 
-class OrderLineSerializer(serializers.HyperlinkedModelSerializer):
+logger = logging.getLogger(__name__)
+
+# Orders leave the paid set when they are done. Incremental clients still
+# need to see that change, so "updated_since" queries include them.
+SYNC_ORDER_STATUSES = (models.Order.PAID, models.Order.DONE)
+
+API_RENDERER_CLASSES = list(api_settings.DEFAULT_RENDERER_CLASSES) + [renderers.MessagePackRenderer]
+
+API_CACHE_VERSION_KEY = "api-cache:version"
+API_CACHE_HITS_KEY = "api-cache:hits"
+API_CACHE_MISSES_KEY = "api-cache:misses"
+
+
+def get_api_cache_version():
+    version = cache.get(API_CACHE_VERSION_KEY)
+    if version is None:
+        # Seed from the clock, so that a version lost to eviction never
+        # comes back as a number that old entries were stored under.
+        cache.add(API_CACHE_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(API_CACHE_VERSION_KEY)
+    return version
+
+
+def invalidate_api_cache():
+    try:
+        try:
+            cache.incr(API_CACHE_VERSION_KEY)
+        except ValueError:
+            get_api_cache_version()
+    except Exception as e:
+        # Cached lists expire on their own; the write must not fail.
+        logger.warning("Could not invalidate the API cache: %s", e)
+
+
+def count_api_cache(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+
+def api_cache_stats():
+    hits = cache.get(API_CACHE_HITS_KEY, 0)
+    misses = cache.get(API_CACHE_MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / total, 4) if total else None,
+    }
+
+
+def format_sync_token(timestamp):
+    return timestamp.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def requested_fields(request):
+    """Returns the set of names passed in ``?fields=``, or None when the
+    client did not ask for a sparse fieldset."""
+    if request is None or not request.query_params.get("fields"):
+        return None
+    return {name.strip() for name in request.query_params["fields"].split(",") if name.strip()}
+
+
+class SparseFieldsetMixin:
+    """Serializer mixin that drops the fields not listed in ``?fields=``."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = requested_fields(self.context.get("request"))
+        if requested is not None:
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+
+class SparseQuerysetMixin:
+    """Viewset mixin that restricts the SELECT to the columns the sparse
+    serializer reads.
+
+    Serializer fields whose value comes from a related row list the columns
+    they need in ``Meta.field_sources``, e.g. ``{"product": ("product__name",)}``;
+    the relations in there are joined with select_related and everything
+    else is left out."""
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        requested = requested_fields(self.request)
+        if requested is None:
+            return queryset
+
+        serializer_class = self.get_serializer_class()
+        field_sources = getattr(serializer_class.Meta, "field_sources", {})
+        fields = serializer_class().fields
+        columns = set()
+        for name in requested & set(fields):
+            columns.update(field_sources.get(name, (fields[name].source,)))
+
+        model = queryset.model
+        for name in getattr(self.pagination_class, "ordering", ()):
+            try:
+                model._meta.get_field(name.lstrip("-"))
+            except FieldDoesNotExist:
+                continue
+            columns.add(name.lstrip("-"))
+
+        queryset = queryset.select_related(None).only("pk", *columns)
+        relations = {column.rsplit("__", 1)[0] for column in columns if "__" in column}
+        if relations:
+            queryset = queryset.select_related(*relations)
+        return queryset
+
+
+class ConditionalResponseMixin:
+    """Viewset mixin that answers list and detail requests with 304 Not
+    Modified while the client's ETag still matches.
+
+    The ETag is derived from one aggregate query over the filtered rows: the
+    row count and the latest value of each field in ``etag_fields``, plus
+    the request path and the negotiated media type."""
+    etag_fields = ("date_updated",)
+
+    def get_etag(self, queryset):
+        aggregates = {"etag_count": Count("pk")}
+        for i, field in enumerate(self.etag_fields):
+            aggregates["etag_max_%d" % i] = Max(field)
+        values = queryset.order_by().aggregate(**aggregates)
+
+        parts = [self.request.get_full_path(), self.request.accepted_media_type or ""]
+        parts.extend(str(values[key]) for key in sorted(values))
+        return quote_etag(hashlib.md5("|".join(parts).encode("utf8")).hexdigest())
+
+    def conditional_response(self, queryset, handler, request, *args, **kwargs):
+        etag = self.get_etag(queryset)
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            return response
+        response = handler(request, *args, **kwargs)
+        response["ETag"] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return self.conditional_response(queryset, super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset()).filter(
+            **{self.lookup_field: kwargs[lookup_url_kwarg]})
+        return self.conditional_response(queryset, super().retrieve, request, *args, **kwargs)
+
+
+class CachedListMixin:
+    """Viewset mixin that serves list responses from the cache.
+
+    Entries are keyed by the normalized query parameters, the negotiated
+    media type and the caller's scope, and carry a global version that
+    ``invalidate_api_cache`` bumps whenever an order, order line or product
+    changes, so a hit does not touch the database at all."""
+    cache_timeout = 300
+
+    def get_cache_scope(self, request):
+        user = request.user
+        if user.is_superuser:
+            return "superuser"
+        return "staff" if user.is_staff else "user"
+
+    def get_cache_key(self, request):
+        params = sorted((key, values) for key, values in request.query_params.lists())
+        parts = [request.path, request.accepted_media_type or "", repr(params)]
+        digest = hashlib.md5("|".join(parts).encode("utf8")).hexdigest()
+        return "api-cache:%s:%s:%s:%s" % (
+            get_api_cache_version(), self.basename, self.get_cache_scope(request), digest)
+
+    def list(self, request, *args, **kwargs):
+        key = self.get_cache_key(request)
+        cached = cache.get(key)
+        if cached is not None:
+            count_api_cache(API_CACHE_HITS_KEY)
+            response = get_conditional_response(request, etag=cached["etag"])
+            if response is None:
+                response = HttpResponse(cached["content"], content_type=cached["content_type"])
+            response["ETag"] = cached["etag"]
+            response["X-Cache"] = "HIT"
+            return response
+
+        count_api_cache(API_CACHE_MISSES_KEY)
+        response = super().list(request, *args, **kwargs)
+        response["X-Cache"] = "MISS"
+        if response.status_code == 200:
+            def store(rendered):
+                cache.set(key, {
+                    "content": rendered.content,
+                    "content_type": rendered["Content-Type"],
+                    "etag": rendered["ETag"],
+                }, self.cache_timeout)
+            response.add_post_render_callback(store)
+        return response
+
+
+class PaidOrderLineCursorPagination(pagination.CursorPagination):
+    # The cursor position has to be a plain attribute of the row, so the
+    # order date is annotated onto each line instead of ordering by
+    # "-order__date_added" directly.
+    ordering = ("-order_date_added", "id")
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
+class PaidOrderCursorPagination(pagination.CursorPagination):
+    ordering = ("-date_added", "id")
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
+class ChangeModelPermissions(permissions.DjangoModelPermissions):
+    """Treat POST as a change, for actions that update existing rows."""
+    perms_map = dict(permissions.DjangoModelPermissions.perms_map,
+                     POST=['%(app_label)s.change_%(model_name)s'])
+
+
+class PaidOrderLineFilter(django_filters.FilterSet):
+    updated_since = django_filters.IsoDateTimeFilter(field_name="date_updated", lookup_expr="gte")
+
+    class Meta:
+        model = models.OrderLine
+        fields = ('order', 'status')
+
+
+class PaidOrderFilter(OrderFilter):
+    updated_since = django_filters.IsoDateTimeFilter(field_name="date_updated", lookup_expr="gte")
+
+
+class OrderLineSerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
     product = serializers.StringRelatedField()
 
     class Meta:
         model = models.OrderLine
-        fields = ('id', 'order', 'product', 'status')
-        read_only_fields = ('id', 'order', 'product')
+        fields = ('id', 'order', 'product', 'status', 'date_updated')
+        read_only_fields = ('id', 'order', 'product', 'date_updated')
+        field_sources = {'product': ('product__name',)}
+
+
+class OrderLineBulkStatusSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=1000)
+    status = serializers.ChoiceField(choices=models.OrderLine.STATUSES)
+
+    def validate(self, attrs):
+        status = attrs["status"]
+        current = dict(self.context["queryset"].filter(
+            id__in=attrs["ids"]).values_list("id", "status"))
+
+        missing = sorted(set(attrs["ids"]) - set(current))
+        if missing:
+            raise serializers.ValidationError(
+                {"ids": "Unknown or unpaid order lines: %s" % missing})
 
+        invalid = sorted(line_id for line_id, line_status in current.items()
+                         if line_status != status
+                         and status not in models.OrderLine.TRANSITIONS.get(line_status, ()))
+        if invalid:
+            raise serializers.ValidationError(
+                {"status": "Order lines %s cannot move to %s" % (
+                    invalid, models.OrderLine(status=status).get_status_display())})
+        return attrs
 
-class PaidOrderLineViewSet(viewsets.ModelViewSet):
-    queryset = models.OrderLine.objects.filter(
-        order__status=models.Order.PAID).order_by("-order__date_added")
+
+class PaidOrderLineViewSet(CachedListMixin, ConditionalResponseMixin, SparseQuerysetMixin, viewsets.ModelViewSet):
+    queryset = models.OrderLine.objects.select_related("product").annotate(
+        order_date_added=F("order__date_added")).order_by("-order_date_added", "id")
     serializer_class = OrderLineSerializer
-    filter_fields = ('order', 'status')
+    pagination_class = PaidOrderLineCursorPagination
+    filterset_class = PaidOrderLineFilter
+    renderer_classes = API_RENDERER_CLASSES
+    # Product names are rendered on each line, so a rename changes the ETag.
+    etag_fields = ("date_updated", "product__date_updated")
+
+    def get_queryset(self):
+        statuses = (models.Order.PAID,)
+        if "updated_since" in self.request.query_params:
+            statuses = SYNC_ORDER_STATUSES
+        return super().get_queryset().filter(order__status__in=statuses)
+
+    @action(detail=False, methods=["post"], url_path="bulk-status",
+            permission_classes=[ChangeModelPermissions])
+    def bulk_status(self, request):
+        queryset = self.get_queryset()
+        serializer = OrderLineBulkStatusSerializer(
+            data=request.data, context={"queryset": queryset})
+        serializer.is_valid(raise_exception=True)
 
+        ids = queryset.filter(id__in=serializer.validated_data["ids"]).set_status(
+            serializer.validated_data["status"])
+        # The lines were changed with update(), which sends no signals.
+        invalidate_api_cache()
+        return Response({"ids": ids})
 
-class OrderSerializer(serializers.HyperlinkedModelSerializer):
+
+class OrderSerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = models.Order
-        fields = ('shipping_name',
+        fields = ('id',
+                  'status',
+                  'shipping_name',
                   'shipping_address1',
                   'shipping_address2',
                   'shipping_zip_code',
@@ -32,7 +338,186 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
                   'date_added')
 
 
-class PaidOrderViewSet(viewsets.ModelViewSet):
-    queryset = models.Order.objects.filter(
-        status=models.Order.PAID).order_by("-date_added")
+class PaidOrderViewSet(CachedListMixin, ConditionalResponseMixin, SparseQuerysetMixin, viewsets.ModelViewSet):
+    queryset = models.Order.objects.order_by("-date_added", "id")
     serializer_class = OrderSerializer
+    pagination_class = PaidOrderCursorPagination
+    filterset_class = PaidOrderFilter
+    renderer_classes = API_RENDERER_CLASSES
+    export_fields = ('id',
+                     'status',
+                     'user__email',
+                     'billing_name',
+                     'billing_address1',
+                     'billing_address2',
+                     'billing_zip_code',
+                     'billing_city',
+                     'billing_country',
+                     'shipping_name',
+                     'shipping_address1',
+                     'shipping_address2',
+                     'shipping_zip_code',
+                     'shipping_city',
+                     'shipping_country',
+                     'date_updated',
+                     'date_added')
+    export_chunk_size = 2000
+
+    def get_queryset(self):
+        statuses = (models.Order.PAID,)
+        if "updated_since" in self.request.query_params:
+            statuses = SYNC_ORDER_STATUSES
+        return super().get_queryset().filter(status__in=statuses)
+
+    # Every order's contact details, so not for whoever may merely read orders
+    @action(detail=False, renderer_classes=[renderers.NDJSONRenderer, renderers.CSVRenderer],
+            permission_classes=[permissions.IsAdminUser])
+    def export(self, request):
+        """Streams every matching order as NDJSON or CSV, chosen with the Accept
+        header or ?format=, without pagination or serializers."""
+        fields = self.export_fields
+        requested = requested_fields(request)
+        if requested is not None:
+            fields = [name for name in fields if name in requested]
+
+        queryset = self.filter_queryset(self.get_queryset())
+        rows = queryset.values_list(*fields).iterator(chunk_size=self.export_chunk_size)
+
+        renderer = request.accepted_renderer
+        if renderer.format == "csv":
+            content = renderers.stream_csv(fields, rows, self.export_chunk_size)
+        else:
+            content = renderers.stream_ndjson(fields, rows, self.export_chunk_size)
+
+        response = StreamingHttpResponse(
+            content, content_type="%s; charset=%s" % (renderer.media_type, renderer.charset))
+        response["Content-Disposition"] = 'attachment; filename="orders.%s"' % renderer.format
+        return response
+
+
+async def async_list(viewset_class, request):
+    """Serves the list action of ``viewset_class`` from an async view.
+
+    This is a wrapper: the viewset runs unchanged, response cache and ETags
+    included, and its response is rendered in one trip to a thread. Django
+    4.1 has no async database access, its async queryset methods run the
+    same queries in a thread too, so the gain over the sync endpoint is
+    only that a slow client holds a coroutine rather than a worker thread."""
+    view = viewset_class.as_view({"get": "list"})
+
+    def respond():
+        response = view(request)
+        if hasattr(response, "render"):
+            response.render()
+        return response
+
+    return await sync_to_async(respond)()
+
+
+async def paid_orderlines_async(request):
+    return await async_list(PaidOrderLineViewSet, request)
+
+
+async def paid_orders_async(request):
+    return await async_list(PaidOrderViewSet, request)
+
+
+class ChatMessageCursorPagination(pagination.CursorPagination):
+    ordering = ("-id",)
+    page_size = 50
+
+
+class ChatMessageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.ChatMessage
+        fields = ("id", "username", "message", "date_added")
+
+
+class ChatMessageListView(generics.ListAPIView):
+    """Older chat history of an order, newest first. Follow the ``next``
+    link to page further back; the last messages are also replayed by the
+    websocket on connect."""
+    serializer_class = ChatMessageSerializer
+    pagination_class = ChatMessageCursorPagination
+    permission_classes = [permissions.IsAuthenticated]
+    filter_backends = []
+
+    def get_queryset(self):
+        orders = models.Order.objects.only("id")
+        if not self.request.user.is_employee:
+            orders = orders.filter(user=self.request.user)
+        order = get_object_or_404(orders, pk=self.kwargs["order_id"])
+        return models.ChatMessage.objects.filter(order=order)
+
+
+def is_employee(request):
+    return request.user.is_authenticated and request.user.is_employee
+
+
+async def chat_presence(request):
+    """Lists the customer service rooms with someone in them, and who."""
+    if not await sync_to_async(is_employee)(request):
+        return JsonResponse({"detail": "Only employees can see chat presence."}, status=403)
+    return JsonResponse({"rooms": await presence.active_rooms()})
+
+
+class SyncView(APIView):
+    """Hands out sync tokens for incremental clients.
+
+    A client stores the token it received, then on its next run calls this
+    view with ``?since=<token>`` to get a new token and the ids deleted since,
+    and fetches ``/api/orders/`` and ``/api/orderlines/`` with
+    ``?updated_since=<old token>``. Tokens trail the clock by ``lag`` so that
+    rows committed by slow transactions are sent again rather than missed;
+    clients should treat rows as upserts."""
+    queryset = models.Tombstone.objects.all()
+    lag = timedelta(seconds=5)
+
+    def get(self, request):
+        since = None
+        if "since" in request.query_params:
+            since = parse_datetime(request.query_params["since"])
+            if since is None:
+                raise serializers.ValidationError({"since": "Invalid sync token."})
+
+        token = timezone.now() - self.lag
+        deleted = {models.Tombstone.ORDER: [], models.Tombstone.ORDERLINE: []}
+        if since is not None:
+            token = max(token, since)
+            tombstones = self.queryset.filter(date_deleted__gte=since).order_by("id")
+            for model, object_id in tombstones.values_list("model", "object_id"):
+                deleted[model].append(object_id)
+
+        return Response({
+            "token": format_sync_token(token),
+            "deleted": {
+                "orders": deleted[models.Tombstone.ORDER],
+                "orderlines": deleted[models.Tombstone.ORDERLINE],
+            },
+        })
+
+
+class APICacheStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(api_cache_stats())
+
+
+class ChatRedisStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(redis_pool.pool_stats())
+
+
+def worker_metrics(request):
+    """This worker's metrics in the Prometheus text format, for scrapers on
+    INTERNAL_IPS and for staff."""
+    if request.META.get("REMOTE_ADDR") not in settings.INTERNAL_IPS and not request.user.is_staff:
+        return HttpResponse(status=403)
+    stats = redis_pool.pool_stats()
+    metrics.chat_redis_connections.set(stats["connections"])
+    metrics.chat_redis_connections_in_use.set(stats["connections_in_use"])
+    metrics.chat_leaked_consumers.set(stats["consumers_leaked"])
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
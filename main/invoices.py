@@ -0,0 +1,262 @@
+"""Invoice PDFs, rendered once and kept on disk.
+
+A PDF is stored under a hash of the invoice HTML, its base URL and
+INVOICE_TEMPLATE_VERSION, so any change to what would be rendered gives a
+new file. Changing an order or its lines also removes the order's files,
+so that stale ones do not accumulate.
+
+Rendering happens in a pool of INVOICE_RENDER_WORKERS long-lived
+processes, each of which loads the fonts and INVOICE_STYLESHEETS once."""
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.template.loader import render_to_string
+from weasyprint import CSS, HTML
+from weasyprint.text.fonts import FontConfiguration
+
+logger = logging.getLogger(__name__)
+
+# Set up once per rendering process by warm_up()
+_font_config = None
+_stylesheets = None
+
+_pool = None
+_pool_pid = None
+
+
+def order_directory(order_id):
+    return os.path.join(settings.INVOICE_CACHE_DIR, str(order_id))
+
+
+def render_html(order):
+    # The stylesheets are applied by the rendering processes, not linked
+    return render_to_string("invoice.html", {"order": order, "pdf": True})
+
+
+def cache_key(html, base_url):
+    content = "%s\n%s\n%s" % (settings.INVOICE_TEMPLATE_VERSION, base_url, html)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def write_atomically(path, content):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as output:
+            output.write(content)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def invoice_path(order, html, base_url):
+    return os.path.join(order_directory(order.id), cache_key(html, base_url) + ".pdf")
+
+
+def stylesheet_paths():
+    paths = []
+    for name in settings.INVOICE_STYLESHEETS:
+        path = finders.find(name)
+        if path is None:
+            logger.warning("Invoice stylesheet %s not found", name)
+        else:
+            paths.append(path)
+    return paths
+
+
+def warm_up(paths):
+    """Loads the fonts and parses the stylesheets of this process, then
+    renders a page so that the first invoice does not pay for the rest."""
+    global _font_config, _stylesheets
+    _font_config = FontConfiguration()
+    _stylesheets = [CSS(filename=path, font_config=_font_config) for path in paths]
+    HTML(string="<p>BookTime</p>").write_pdf(stylesheets=_stylesheets, font_config=_font_config)
+
+
+def render_pdf(html, base_url):
+    if _font_config is None:
+        warm_up(stylesheet_paths())
+    return HTML(string=html, base_url=base_url).write_pdf(
+        stylesheets=_stylesheets, font_config=_font_config)
+
+
+def render_pool():
+    """The rendering processes of this web process, started on first use.
+    A pool inherited through fork belongs to the parent and is replaced."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ProcessPoolExecutor(
+            settings.INVOICE_RENDER_WORKERS, initializer=warm_up, initargs=(stylesheet_paths(),))
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.shutdown(cancel_futures=True)
+    _pool = None
+
+
+def submit_render(html, base_url):
+    """Returns a future of the rendered PDF. With no rendering processes
+    configured the PDF is rendered here, before returning."""
+    if settings.INVOICE_RENDER_WORKERS:
+        try:
+            return render_pool().submit(render_pdf, html, base_url)
+        except BrokenProcessPool:
+            # A rendering process died, which makes the pool refuse new work
+            shutdown_pool()
+            return render_pool().submit(render_pdf, html, base_url)
+    future = Future()
+    try:
+        future.set_result(render_pdf(html, base_url))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def render_again(html, base_url):
+    """Resubmits a render that was lost with its rendering process."""
+    logger.warning("An invoice rendering process died, rendering again")
+    return submit_render(html, base_url)
+
+
+def save_pdf(path, pdf, started):
+    """Writes a PDF whose render began at ``started``, then removes the
+    order's PDFs written before that. Ones written since come from renders
+    that finished first and may be newer, e.g. after a timed out render."""
+    write_atomically(path, pdf)
+    directory = os.path.dirname(path)
+    # Another request may be removing them too
+    with contextlib.suppress(FileNotFoundError):
+        for name in os.listdir(directory):
+            other = os.path.join(directory, name)
+            if not name.endswith(".pdf") or other == path:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                if os.stat(other).st_mtime < started:
+                    os.unlink(other)
+
+
+def store_pdf(path, pdf, started):
+    """Writes a freshly rendered PDF and returns it opened for reading."""
+    save_pdf(path, pdf, started)
+    return open(path, "rb")
+
+
+def open_invoice_pdf(order, base_url):
+    """Returns ``order``'s invoice PDF opened for reading, rendering it only
+    if there is no file for its current content.
+
+    Raises concurrent.futures.TimeoutError if rendering takes longer than
+    INVOICE_RENDER_TIMEOUT seconds; the PDF is still stored once rendered."""
+    html = render_html(order)
+    path = invoice_path(order, html, base_url)
+    try:
+        return open(path, "rb")
+    except FileNotFoundError:
+        pass
+
+    logger.info("Rendering invoice for order %d", order.id)
+    started = time.time()
+    future = submit_render(html, base_url)
+    try:
+        try:
+            pdf = future.result(timeout=settings.INVOICE_RENDER_TIMEOUT)
+        except BrokenProcessPool:
+            future = render_again(html, base_url)
+            pdf = future.result(timeout=settings.INVOICE_RENDER_TIMEOUT)
+    except TimeoutError:
+        future.add_done_callback(
+            lambda future: future.exception() or save_pdf(path, future.result(), started))
+        raise
+    return store_pdf(path, pdf, started)
+
+
+def rendered_invoices(orders, base_url, window):
+    """Yields (order, PDF opened for reading) for each of ``orders``, in
+    order. Missing PDFs are rendered in the pool, with at most ``window``
+    orders between the one being rendered and the one yielded, so memory
+    does not grow with the number of orders."""
+    pending = collections.deque()
+
+    def oldest():
+        order, path, future, started = pending.popleft()
+        if future is None:
+            with contextlib.suppress(FileNotFoundError):
+                return order, open(path, "rb")
+            # Removed since, by a change to the order
+            started = time.time()
+            future = submit_render(render_html(order), base_url)
+        try:
+            pdf = future.result()
+        except BrokenProcessPool:
+            pdf = render_again(render_html(order), base_url).result()
+        return order, store_pdf(path, pdf, started)
+
+    try:
+        for order in orders:
+            html = render_html(order)
+            path = invoice_path(order, html, base_url)
+            started = time.time()
+            future = None if os.path.exists(path) else submit_render(html, base_url)
+            pending.append((order, path, future, started))
+            if len(pending) >= window:
+                yield oldest()
+        while pending:
+            yield oldest()
+    finally:
+        # Left over when the download is abandoned or fails
+        for _, _, future, _ in pending:
+            if future is not None:
+                future.cancel()
+
+
+class StreamBuffer:
+    """A write-only file whose content is taken out as it is written."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def invoices_zip(orders, base_url):
+    """Yields a ZIP of the invoices of ``orders`` as it is built."""
+    buffer = StreamBuffer()
+    window = max(settings.INVOICE_RENDER_WORKERS, 1) * 2
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for order, invoice in rendered_invoices(orders, base_url, window):
+            with invoice, archive.open("invoice-BT%d.pdf" % order.id, "w") as entry:
+                shutil.copyfileobj(invoice, entry)
+            yield buffer.take()
+    # The central directory is written when the archive is closed
+    yield buffer.take()
+
+
+def invalidate(order_id):
+    shutil.rmtree(order_directory(order_id), ignore_errors=True)
@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main import rollups
+
+
+class Command(BaseCommand):
+    help = "Recompute the daily order and product sales rollups from the orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int,
+                            help="Only recompute this many past days; all history by default")
+
+    def handle(self, *args, **options):
+        since = None
+        if options["days"] is not None:
+            since = timezone.localdate() - timedelta(days=options["days"])
+        count = rollups.rebuild(since)
+        self.stdout.write("Rollups written=%d" % count)
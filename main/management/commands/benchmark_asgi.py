@@ -0,0 +1,197 @@
+import asyncio
+import io
+import json
+import platform
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import django
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+
+from main import models
+from main.asgi import StreamingASGIHandler
+
+from .benchmark_import import git_revision
+
+# The async API lists run the sync viewsets, response cache included, so
+# each pair differs only in how it is served.
+TARGETS = {
+    "products": ("/products/all/", "/async/products/all/"),
+    "orders": ("/api/orders/", "/api/async/orders/"),
+    "orderlines": ("/api/orderlines/", "/api/async/orderlines/"),
+}
+
+
+class ThreadSampler:
+    def __init__(self):
+        self.peak = threading.active_count()
+
+    def sample(self):
+        self.peak = max(self.peak, threading.active_count())
+
+
+class Command(BaseCommand):
+    help = ("Compare the sync views served through WSGI with their async "
+            "variants served through ASGI, in process, with slow clients")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=400)
+        parser.add_argument("--concurrency", type=int, default=100,
+                            help="Number of simultaneous client connections")
+        parser.add_argument("--client-delay", type=float, default=0.05,
+                            help="Seconds each client takes to read the response body")
+        parser.add_argument("--products", type=int, default=100)
+        parser.add_argument("--orders", type=int, default=200)
+        parser.add_argument("--target", choices=sorted(TARGETS), action="append")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        # The toolbar middleware is sync only and DEBUG keeps every query in
+        # memory; neither belongs in a throughput measurement.
+        middleware = [m for m in settings.MIDDLEWARE if "debug_toolbar" not in m]
+        try:
+            with override_settings(DEBUG=False, ALLOWED_HOSTS=["localhost"], MIDDLEWARE=middleware):
+                cookie = self.populate(options)
+                results = {}
+                for target in options["target"] or sorted(TARGETS):
+                    sync_path, async_path = TARGETS[target]
+                    results[target] = {
+                        "wsgi": self.run_wsgi(sync_path, cookie, options),
+                        "asgi": self.run_asgi(async_path, cookie, options),
+                    }
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            "parameters": {
+                key: options[key] for key in (
+                    "requests", "concurrency", "client_delay", "products", "orders")
+            },
+            "environment": {
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+            },
+            "results": results,
+        }
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+
+    def populate(self, options):
+        user = models.User.objects.create_superuser("benchmark@booktime.domain", "benchmark")
+        products = models.Product.objects.bulk_create(
+            models.Product(name="Product %d" % i, slug="product-%d" % i, price=Decimal("10.00"))
+            for i in range(options["products"])
+        )
+        for i in range(options["orders"]):
+            order = models.Order.objects.create(user=user, status=models.Order.PAID)
+            models.OrderLine.objects.create(order=order, product=products[i % len(products)])
+
+        client = Client()
+        client.force_login(user)
+        return "%s=%s" % (settings.SESSION_COOKIE_NAME, client.cookies[settings.SESSION_COOKIE_NAME].value)
+
+    def summarize(self, elapsed, statuses, peak_bytes, threads, options):
+        return {
+            "seconds": round(elapsed, 4),
+            "requests_per_second": round(options["requests"] / elapsed, 2),
+            "errors": sum(1 for status in statuses if status != 200),
+            "peak_threads": threads,
+            "python_heap_kb_per_connection": round(peak_bytes / 1024 / options["concurrency"], 2),
+        }
+
+    def run_wsgi(self, path, cookie, options):
+        handler = WSGIHandler()
+        sampler = ThreadSampler()
+        statuses = []
+
+        def request(_):
+            environ = {
+                "REQUEST_METHOD": "GET",
+                "PATH_INFO": path,
+                "QUERY_STRING": "",
+                "SCRIPT_NAME": "",
+                "SERVER_NAME": "localhost",
+                "SERVER_PORT": "80",
+                "SERVER_PROTOCOL": "HTTP/1.1",
+                "HTTP_HOST": "localhost",
+                "HTTP_COOKIE": cookie,
+                "wsgi.input": io.BytesIO(b""),
+                "wsgi.url_scheme": "http",
+            }
+
+            def start_response(status, headers, exc_info=None):
+                statuses.append(int(status.split()[0]))
+
+            body = handler(environ, start_response)
+            try:
+                # A slow client keeps the worker thread busy while it reads.
+                for chunk in body:
+                    time.sleep(options["client_delay"])
+                sampler.sample()
+            finally:
+                body.close()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            list(executor.map(request, range(options["requests"])))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return self.summarize(elapsed, statuses, peak, sampler.peak, options)
+
+    def run_asgi(self, path, cookie, options):
+        handler = StreamingASGIHandler()
+        sampler = ThreadSampler()
+        statuses = []
+
+        async def request(semaphore):
+            scope = {
+                "type": "http",
+                "asgi": {"version": "3.0"},
+                "http_version": "1.1",
+                "method": "GET",
+                "scheme": "http",
+                "path": path,
+                "raw_path": path.encode(),
+                "query_string": b"",
+                "root_path": "",
+                "headers": [(b"host", b"localhost"), (b"cookie", cookie.encode())],
+                "server": ("localhost", 80),
+            }
+
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            async def send(message):
+                if message["type"] == "http.response.start":
+                    statuses.append(message["status"])
+                elif message["type"] == "http.response.body":
+                    # The same slow client only holds a coroutine here.
+                    await asyncio.sleep(options["client_delay"])
+                    sampler.sample()
+
+            async with semaphore:
+                await handler(scope, receive, send)
+
+        async def run():
+            semaphore = asyncio.Semaphore(options["concurrency"])
+            await asyncio.gather(*(request(semaphore) for _ in range(options["requests"])))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return self.summarize(elapsed, statuses, peak, sampler.peak, options)
@@ -0,0 +1,164 @@
+import csv
+import json
+import os.path
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import StringIO
+
+import django
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from PIL import Image
+
+from main import models
+
+
+class QueryCounter:
+    """Counts executed queries without keeping them around, so the
+    measurement does not inflate the memory figures it sits next to."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    if sys.platform == "darwin":
+        return usage // 1024
+    return usage
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=settings.BASE_DIR,
+            stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Benchmark import_data against a synthetic catalog in a scratch database'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=500)
+        parser.add_argument("--tags", type=int, default=20,
+                            help="Number of distinct tags in the catalog")
+        parser.add_argument("--tags-per-row", type=int, default=2)
+        parser.add_argument("--duplicate-ratio", type=float, default=0.1,
+                            help="Fraction of rows repeating an earlier product")
+        parser.add_argument("--images", type=int, default=10,
+                            help="Number of distinct image files to generate")
+        parser.add_argument("--image-size", type=int, default=600,
+                            help="Width and height in pixels of generated images")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--output", type=str, default=None,
+                            help="Write the JSON report to this file instead of stdout")
+
+    def generate_catalog(self, workdir, options):
+        rnd = random.Random(options["seed"])
+        image_dir = os.path.join(workdir, "images")
+        os.mkdir(image_dir)
+
+        image_names = []
+        for i in range(options["images"]):
+            name = "image-%d.jpg" % i
+            color = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+            size = (options["image_size"], options["image_size"])
+            Image.new("RGB", size, color).save(os.path.join(image_dir, name), "JPEG")
+            image_names.append(name)
+
+        tags = ["tag-%d" % i for i in range(options["tags"])]
+        tags_per_row = min(options["tags_per_row"], len(tags))
+        csv_path = os.path.join(workdir, "catalog.csv")
+        rows = []
+        for i in range(options["rows"]):
+            if rows and rnd.random() < options["duplicate_ratio"]:
+                rows.append(rnd.choice(rows))
+                continue
+            rows.append({
+                "name": "Product %d" % i,
+                "description": "Synthetic product number %d" % i,
+                "tags": "|".join(rnd.sample(tags, tags_per_row)),
+                "image_filename": rnd.choice(image_names),
+                "price": "%.2f" % rnd.uniform(1, 1000),
+            })
+
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.DictWriter(
+                f, fieldnames=["name", "description", "tags", "image_filename", "price"])
+            writer.writeheader()
+            writer.writerows(rows)
+        return csv_path, image_dir
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as workdir:
+            csv_path, image_dir = self.generate_catalog(workdir, options)
+            media_root = os.path.join(workdir, "media")
+
+            old_name = connection.settings_dict["NAME"]
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                with override_settings(MEDIA_ROOT=media_root):
+                    report = self.run_import(csv_path, image_dir, options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def run_import(self, csv_path, image_dir, options):
+        counter = QueryCounter()
+        rss_before = peak_rss_kb()
+
+        with connection.execute_wrapper(counter):
+            start = time.perf_counter()
+            call_command("import_data", csv_path, image_dir, stdout=StringIO())
+            elapsed = time.perf_counter() - start
+
+        rows = options["rows"]
+        images = models.ProductImage.objects.count()
+        return {
+            "parameters": {
+                key: options[key] for key in (
+                    "rows", "tags", "tags_per_row", "duplicate_ratio",
+                    "images", "image_size", "seed",
+                )
+            },
+            "environment": {
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+            },
+            "results": {
+                "seconds": round(elapsed, 4),
+                "rows_per_second": round(rows / elapsed, 2) if elapsed else None,
+                "queries": counter.count,
+                "queries_per_row": round(counter.count / rows, 2) if rows else None,
+                "images_imported": images,
+                "images_per_second": round(images / elapsed, 2) if elapsed else None,
+                "products": models.Product.objects.count(),
+                "tags": models.ProductTag.objects.count(),
+                "peak_rss_kb": peak_rss_kb(),
+                "peak_rss_growth_kb": peak_rss_kb() - rss_before,
+            },
+        }
@@ -0,0 +1,86 @@
+import json
+import platform
+import time
+from decimal import Decimal
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from weasyprint import CSS, HTML
+from weasyprint.text.fonts import FontConfiguration
+
+from main import invoices, models
+from main.metrics import percentiles
+
+from .benchmark_import import git_revision, peak_rss_kb
+
+
+def render_cold(html, base_url, paths):
+    """Renders the way every request used to: fonts and stylesheets are
+    loaded again for each invoice."""
+    font_config = FontConfiguration()
+    stylesheets = [CSS(filename=path, font_config=font_config) for path in paths]
+    return HTML(string=html, base_url=base_url).write_pdf(stylesheets=stylesheets, font_config=font_config)
+
+
+class Command(BaseCommand):
+    help = ("Measure invoice rendering latency with fonts and stylesheets loaded "
+            "for every invoice (cold) and by long-lived rendering workers (warm)")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--invoices", type=int, default=100,
+                            help="Invoices rendered in each mode")
+        parser.add_argument("--lines", type=int, default=3, help="Lines per order")
+        parser.add_argument("--workers", type=int, default=2)
+        parser.add_argument("--base-url", default="http://localhost:8000/")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(INVOICE_RENDER_WORKERS=options["workers"]):
+                results = self.run(options)
+        finally:
+            invoices.shutdown_pool()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            "parameters": {key: options[key] for key in ("invoices", "lines", "workers")},
+            "environment": {
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+            },
+            "results": results,
+        }
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+
+    def run(self, options):
+        user = models.User.objects.create_user("benchmark@booktime.domain", "benchmark")
+        product = models.Product.objects.create(name="Benchmark book", slug="benchmark-book",
+                                                price=Decimal("10.00"))
+        pages = []
+        for i in range(options["invoices"]):
+            order = models.Order.objects.create(user=user, billing_name="Customer %d" % i)
+            models.OrderLine.objects.bulk_create(
+                models.OrderLine(order=order, product=product) for _ in range(options["lines"]))
+            pages.append(invoices.render_html(order))
+
+        base_url = options["base_url"]
+        paths = invoices.stylesheet_paths()
+
+        def measure(render):
+            latencies = []
+            for html in pages:
+                start = time.perf_counter()
+                render(html)
+                latencies.append(time.perf_counter() - start)
+            return percentiles(latencies)
+
+        cold = measure(lambda html: render_cold(html, base_url, paths))
+        # Start the workers before measuring, as a deployed pool would be
+        for future in [invoices.submit_render(pages[0], base_url) for _ in range(options["workers"])]:
+            future.result()
+        warm = measure(lambda html: invoices.submit_render(html, base_url).result())
+        return {"cold": cold, "warm": warm, "peak_rss_kb": peak_rss_kb()}
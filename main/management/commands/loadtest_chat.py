@@ -0,0 +1,201 @@
+import asyncio
+import json
+import platform
+import time
+import tracemalloc
+
+import django
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from main import assignment, chat_history, models, redis_pool
+from main.metrics import percentiles
+
+from .benchmark_import import git_revision, peak_rss_kb
+
+LAYERS = {
+    "memory": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+    "redis": settings.CHANNEL_LAYERS["default"],
+}
+
+
+def session_cookie(user):
+    session = SessionStore()
+    session["_auth_user_id"] = str(user.pk)
+    session["_auth_user_backend"] = "django.contrib.auth.backends.ModelBackend"
+    session["_auth_user_hash"] = user.get_session_auth_hash()
+    session.create()
+    return ("%s=%s" % (settings.SESSION_COOKIE_NAME, session.session_key)).encode()
+
+
+class Command(BaseCommand):
+    help = ("Open many simulated customer and employee chat sockets against the "
+            "in-process ASGI application and measure connect and fan-out latency")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=500,
+                            help="Number of orders with an open chat")
+        parser.add_argument("--clients-per-room", type=int, default=2,
+                            help="Customer sockets per room, e.g. open tabs")
+        parser.add_argument("--employees-per-room", type=int, default=2)
+        parser.add_argument("--employees", type=int, default=20,
+                            help="Distinct employee accounts sharing the rooms")
+        parser.add_argument("--messages", type=int, default=3,
+                            help="Messages sent by a customer in each room")
+        parser.add_argument("--concurrency", type=int, default=200,
+                            help="Sockets connecting at the same time")
+        parser.add_argument("--channel-layer", choices=sorted(LAYERS), default="memory")
+        parser.add_argument("--timeout", type=float, default=30)
+        parser.add_argument("--trace-memory", action="store_true",
+                            help="Measure Python heap per connection; slows connects down")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        layers = {"default": LAYERS[options["channel_layer"]]}
+        overrides = {}
+        if options["channel_layer"] == "memory":
+            # No lobby sockets are opened, so nobody is online and chats only
+            # queue; keeping the queue and the cache in process leaves Redis
+            # out entirely.
+            overrides = {
+                "CHAT_ASSIGNMENT_STORE": "main.assignment.LocalAssignmentStore",
+                "CACHES": {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+            }
+        old_store, assignment._store = assignment._store, None
+        try:
+            with override_settings(CHANNEL_LAYERS=layers, ALLOWED_HOSTS=["localhost"], **overrides):
+                if overrides:
+                    assignment._store = assignment.LocalAssignmentStore(online=[])
+                sockets = self.populate(options)
+                results = asyncio.run(self.run(sockets, options))
+        finally:
+            assignment._store = old_store
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            "parameters": {
+                key: options[key] for key in (
+                    "rooms", "clients_per_room", "employees_per_room", "employees",
+                    "messages", "concurrency", "channel_layer")
+            },
+            "environment": {
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+            },
+            "results": results,
+        }
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+
+    def populate(self, options):
+        """Returns (order id, session cookie, is customer) for every socket."""
+        group = Group.objects.create(name="Employees")
+        employees = []
+        for i in range(options["employees"]):
+            employee = models.User.objects.create_user(
+                "employee%d@booktime.domain" % i, "loadtest", is_staff=True)
+            employee.groups.add(group)
+            employees.append(session_cookie(employee))
+
+        sockets = []
+        for i in range(options["rooms"]):
+            customer = models.User.objects.create_user("customer%d@booktime.domain" % i, "loadtest")
+            order = models.Order.objects.create(user=customer, status=models.Order.PAID)
+            cookie = session_cookie(customer)
+            sockets.extend((order.id, cookie, True) for _ in range(options["clients_per_room"]))
+            sockets.extend(
+                (order.id, employees[(i + j) % len(employees)], False)
+                for j in range(options["employees_per_room"])
+            )
+        return sockets
+
+    async def run(self, sockets, options):
+        from booktime.routing import application
+
+        semaphore = asyncio.Semaphore(options["concurrency"])
+        timeout = options["timeout"]
+
+        async def open_socket(order_id, cookie):
+            communicator = WebsocketCommunicator(
+                application, "/ws/customer-service/%d/" % order_id,
+                headers=[(b"cookie", cookie), (b"origin", b"http://localhost")],
+            )
+            async with semaphore:
+                start = time.perf_counter()
+                connected, _ = await communicator.connect(timeout=timeout)
+                if connected:
+                    # Connected means authorized and history replayed
+                    await communicator.receive_json_from(timeout=timeout)
+                return communicator, connected, time.perf_counter() - start
+
+        if options["trace_memory"]:
+            tracemalloc.start()
+        rss_before = peak_rss_kb()
+        heap_before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        opened = await asyncio.gather(*(open_socket(order_id, cookie) for order_id, cookie, _ in sockets))
+        connect_seconds = time.perf_counter() - start
+        heap_after = tracemalloc.get_traced_memory()[0]
+        rss_after = peak_rss_kb()
+        tracemalloc.stop()
+
+        rooms = {}
+        for (order_id, _, is_customer), (communicator, connected, _) in zip(sockets, opened):
+            if connected:
+                rooms.setdefault(order_id, []).append((communicator, is_customer))
+
+        async def receive_messages(communicator, expected):
+            latencies = []
+            while len(latencies) < expected:
+                event = await communicator.receive_json_from(timeout=timeout)
+                # Acknowledged as often as the chat page does
+                if event.get("seq") and event["seq"] % 10 == 0:
+                    await communicator.send_json_to({"type": "ack", "seq": event["seq"]})
+                if event["type"] == "chat_message":
+                    latencies.append(time.perf_counter() - float(event["message"]))
+            return latencies
+
+        async def chat(members):
+            sender = next(c for c, is_customer in members if is_customer)
+            receivers = [receive_messages(c, options["messages"]) for c, _ in members if c is not sender]
+            listening = asyncio.gather(*receivers)
+            for _ in range(options["messages"]):
+                await sender.send_json_to({"type": "message", "message": repr(time.perf_counter())})
+            return [latency for latencies in await listening for latency in latencies]
+
+        start = time.perf_counter()
+        fan_out = await asyncio.gather(*(
+            chat(members) for members in rooms.values()
+            if any(is_customer for _, is_customer in members)
+        ))
+        fan_out_seconds = time.perf_counter() - start
+        await asyncio.gather(*(communicator.disconnect() for communicator, _, _ in opened))
+        await chat_history.flush()
+        # The pool belongs to this run's event loop, which closes next
+        await redis_pool.close_pool()
+
+        connected = sum(1 for _, ok, _ in opened if ok)
+        results = {
+            "sockets": len(sockets),
+            "connected": connected,
+            "refused": len(sockets) - connected,
+            "connect_seconds": round(connect_seconds, 4),
+            "connects_per_second": round(len(sockets) / connect_seconds, 2),
+            "connect_latency": percentiles([latency for _, ok, latency in opened if ok]),
+            "fan_out_seconds": round(fan_out_seconds, 4),
+            "fan_out_latency": percentiles([latency for latencies in fan_out for latency in latencies]),
+            "rss_kb_per_connection": round((rss_after - rss_before) / max(connected, 1), 2),
+            "peak_rss_kb": peak_rss_kb(),
+            "messages_stored": await models.ChatMessage.objects.acount(),
+        }
+        if options["trace_memory"]:
+            results["python_heap_kb_per_connection"] = round(
+                (heap_after - heap_before) / 1024 / max(connected, 1), 2)
+        return results
@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+import json
+import platform
+import random
+import statistics
+
+from django.core.management.base import BaseCommand
+
+from main.assignment import LocalAssignmentStore
+
+from .benchmark_import import git_revision
+
+
+class RandomAssignmentStore(LocalAssignmentStore):
+    """Any employee with a free slot, as when whoever notices a chat first
+    takes it."""
+
+    def __init__(self, rng):
+        super().__init__()
+        self.rng = rng
+
+    def choose(self, candidates, max_rooms):
+        free = [c for c in candidates if self.load.get(c, 0) < max_rooms]
+        return self.rng.choice(free) if free else None
+
+
+def arrivals(options, rng):
+    """Yields (arrival, duration) of every chat, in seconds. Chats arrive
+    as a Poisson process whose rate jumps to the burst rate for the first
+    burst-length minutes of every burst-every minutes."""
+    end = options["hours"] * 3600
+    peak = max(options["rate"], options["burst_rate"]) / 60
+    t = 0
+    while True:
+        t += rng.expovariate(peak)
+        if t >= end:
+            return
+        burst = t % (options["burst_every"] * 60) < options["burst_length"] * 60
+        rate = (options["burst_rate"] if burst else options["rate"]) / 60
+        if rng.random() < rate / peak:
+            yield t, rng.expovariate(1 / (options["chat_minutes"] * 60))
+
+
+def percentile(samples, fraction):
+    return round(samples[min(len(samples) - 1, int(len(samples) * fraction))], 2)
+
+
+async def simulate(store, chats, employees, max_rooms, slowdown):
+    waits = []
+    handled = dict.fromkeys(employees, 0)
+    queued_at = {}
+    longest_queue = 0
+    events = [(arrival, room, "arrive") for room, (arrival, _) in enumerate(chats)]
+    heapq.heapify(events)
+
+    def start(room, employee, now):
+        waits.append(now - queued_at.pop(room))
+        handled[employee] += 1
+        # Attention is split between an employee's chats, so each one they
+        # already have makes this one last longer
+        duration = chats[room][1] * (1 + slowdown * (store.load[employee] - 1))
+        heapq.heappush(events, (now + duration, room, "end"))
+
+    while events:
+        now, room, kind = heapq.heappop(events)
+        if kind == "arrive":
+            queued_at[room] = now
+            employee = await store.assign(room, employees, max_rooms, now)
+            if employee is not None:
+                start(room, employee, now)
+            longest_queue = max(longest_queue, len(store.waiting))
+        else:
+            employee, next_room = await store.release(room)
+            if next_room is not None:
+                start(next_room, employee, now)
+
+    waits.sort()
+    return {
+        "chats": len(waits),
+        "waited": sum(1 for wait in waits if wait > 0),
+        "wait_mean_s": round(statistics.mean(waits), 2) if waits else 0,
+        "wait_p50_s": percentile(waits, 0.50) if waits else 0,
+        "wait_p95_s": percentile(waits, 0.95) if waits else 0,
+        "wait_p99_s": percentile(waits, 0.99) if waits else 0,
+        "wait_max_s": round(waits[-1], 2) if waits else 0,
+        "longest_queue": longest_queue,
+        "chats_per_employee_stdev": round(statistics.pstdev(handled.values()), 2),
+    }
+
+
+class Command(BaseCommand):
+    help = ("Simulate bursty customer chat traffic against the employee "
+            "assignment policy and report how long customers wait")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--employees", type=int, default=10)
+        parser.add_argument("--max-rooms", type=int, default=3,
+                            help="Chats one employee handles at a time")
+        parser.add_argument("--hours", type=float, default=8)
+        parser.add_argument("--rate", type=float, default=2,
+                            help="Chats per minute outside bursts")
+        parser.add_argument("--burst-rate", type=float, default=12,
+                            help="Chats per minute during bursts")
+        parser.add_argument("--burst-every", type=float, default=60, help="Minutes")
+        parser.add_argument("--burst-length", type=float, default=5, help="Minutes")
+        parser.add_argument("--chat-minutes", type=float, default=5,
+                            help="Mean length of a chat handled alone")
+        parser.add_argument("--slowdown", type=float, default=0.3,
+                            help="Extra length of a chat per other chat its employee handles")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        chats = list(arrivals(options, rng))
+        employees = ["employee%d" % i for i in range(options["employees"])]
+        policies = {
+            "least_loaded": LocalAssignmentStore(),
+            "random": RandomAssignmentStore(random.Random(options["seed"])),
+        }
+        results = {
+            name: asyncio.run(simulate(
+                store, chats, employees, options["max_rooms"], options["slowdown"]))
+            for name, store in policies.items()
+        }
+
+        report = {
+            "parameters": {
+                key: options[key] for key in (
+                    "employees", "max_rooms", "hours", "rate", "burst_rate",
+                    "burst_every", "burst_length", "chat_minutes", "slowdown", "seed")
+            },
+            "environment": {
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+            },
+            "results": results,
+        }
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
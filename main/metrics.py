@@ -0,0 +1,186 @@
+"""Process-local metrics exposed in the Prometheus text format.
+
+Each worker keeps its own values; the scraper is expected to scrape every
+worker and aggregate. Recording is a dictionary update under a lock, cheap
+enough for the websocket hot paths."""
+import bisect
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def remove(self, **labels):
+        """Drops one labelled series, to keep label cardinality bounded."""
+        with self.lock:
+            self.values.pop(self.key(labels), None)
+
+    def samples(self):
+        with self.lock:
+            return [("", key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        for suffix, key, value, *extra in self.samples():
+            lines.append("%s%s%s %s" % (
+                self.name, suffix, format_labels(self.labelnames, key, *extra), format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One slot per bucket, one for +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        counts = self.values.get(self.key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", key, cumulative, [("le", format_value(bound))]))
+            samples.append(("_count", key, cumulative))
+            samples.append(("_sum", key, counts[-1]))
+        return samples
+
+
+def render():
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# Chat subsystem
+
+chat_connections = Gauge(
+    "booktime_chat_connections", "Chat sockets open in this worker")
+chat_connects = Counter(
+    "booktime_chat_connects_total", "Chat connection attempts by outcome", ["outcome"])
+chat_disconnects = Counter(
+    "booktime_chat_disconnects_total", "Chat sockets closed, by close code", ["code"])
+chat_slow_consumers = Counter(
+    "booktime_chat_slow_consumers_total", "Chat sockets closed for not keeping up")
+chat_received = Counter(
+    "booktime_chat_received_total", "Frames received from chat clients, by type", ["type"])
+chat_room_messages = Counter(
+    "booktime_chat_room_messages_total",
+    "Messages sent per room; only rooms with a socket open in this worker are kept", ["room"])
+chat_group_send_seconds = Histogram(
+    "booktime_chat_group_send_seconds", "Time to hand a chat event to the channel layer for fan-out")
+chat_heartbeat_writes = Counter(
+    "booktime_chat_heartbeat_writes_total", "Presence entries written to Redis")
+chat_presence_flush_seconds = Histogram(
+    "booktime_chat_presence_flush_seconds", "Time to write one batch of heartbeats to Redis")
+chat_history_writes = Counter(
+    "booktime_chat_history_writes_total", "Chat messages written to the database")
+chat_redis_connections = Gauge(
+    "booktime_chat_redis_connections", "Connections in this worker's shared Redis pool")
+chat_redis_connections_in_use = Gauge(
+    "booktime_chat_redis_connections_in_use", "Connections of this worker's Redis pool running a command")
+chat_leaked_consumers = Gauge(
+    "booktime_chat_leaked_consumers", "Chat consumers that were collected without being closed")
+
+
+def percentiles(samples):
+    """Summarizes latencies in seconds, in milliseconds, for the reports of
+    the benchmark and load-test commands."""
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def at(fraction):
+        return round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 3)
+
+    return {
+        "count": len(samples),
+        "mean_ms": round(statistics.mean(samples) * 1000, 3),
+        "p50_ms": at(0.50),
+        "p95_ms": at(0.95),
+        "p99_ms": at(0.99),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
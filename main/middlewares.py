@@ -1,17 +1,31 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.utils.decorators import sync_and_async_middleware
+
 from . import models
 
 
+def get_basket(request):
+    if 'basket_id' in request.session:
+        basket_id = request.session['basket_id']
+        try:
+            return models.Basket.objects.get(id=basket_id)
+        except models.Basket.DoesNotExist:
+            return None
+    return None
+
+
+@sync_and_async_middleware
 def basket_middleware(get_response):
-    def middleware(request):
-        if 'basket_id' in request.session:
-            basket_id = request.session['basket_id']
-            try:
-                basket = models.Basket.objects.get(id=basket_id)
-            except models.Basket.DoesNotExist:
-                basket = None
-            request.basket = basket
-        else:
-            request.basket = None
-        response = get_response(request)
-        return response
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            request.basket = await sync_to_async(get_basket)(request)
+            response = await get_response(request)
+            return response
+    else:
+        def middleware(request):
+            request.basket = get_basket(request)
+            response = get_response(request)
+            return response
     return middleware
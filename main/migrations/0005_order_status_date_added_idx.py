@@ -0,0 +1,17 @@
+# Generated by Django 4.1.13 on 2026-10-19 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_order_orderline'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', '-date_added', 'id'], name='order_status_date_added_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.1.13 on 2026-10-19 19:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_order_status_date_added_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='date_updated',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='orderline',
+            name='date_updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(choices=[('order', 'Order'), ('orderline', 'Order line')], max_length=16)),
+                ('object_id', models.PositiveIntegerField()),
+                ('date_deleted', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
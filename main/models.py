@@ -3,10 +3,16 @@ import logging
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.core import exceptions
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.dispatch import Signal
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
+# Sent by OrderLineQuerySet.set_status with the (line id, order id) pairs it
+# moved to ``status``, since update() sends no post_save
+orderlines_status_changed = Signal()
+
 
 class UserManager(BaseUserManager):
     use_in_migrations = True
@@ -193,7 +199,27 @@ class BasketLine(models.Model):
     quantity = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
 
 
-class Order(models.Model):
+class StatusTrackingMixin:
+    """Remembers the status an instance was loaded with, so that a save
+    changing it can be told apart from any other save."""
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = dict(zip(field_names, values)).get("status")
+        return instance
+
+    @property
+    def status_changed(self):
+        return getattr(self, "_loaded_status", None) != self.status
+
+    def save(self, *args, **kwargs):
+        # post_save receivers still see the old status
+        super().save(*args, **kwargs)
+        self._loaded_status = self.status
+
+
+class Order(StatusTrackingMixin, models.Model):
     NEW = 10
     PAID = 20
     DONE = 30
@@ -216,11 +242,39 @@ class Order(models.Model):
     shipping_city = models.CharField(max_length=60)
     shipping_country = models.CharField(max_length=3)
 
-    date_updated = models.DateTimeField(auto_now=True)
+    date_updated = models.DateTimeField(auto_now=True, db_index=True)
     date_added = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "-date_added", "id"], name="order_status_date_added_idx"),
+        ]
+
+
+class OrderLineQuerySet(models.QuerySet):
+    def set_status(self, status):
+        """Move the lines allowed to go to ``status`` with a single UPDATE and
+        mark the orders left without pending lines as done.
+
+        Returns the ids of the lines that changed."""
+        sources = [s for s, targets in OrderLine.TRANSITIONS.items() if status in targets]
+        with transaction.atomic():
+            lines = list(self.filter(status__in=sources).select_for_update().values_list("id", "order_id"))
+            ids = [line_id for line_id, order_id in lines]
+            OrderLine.objects.filter(id__in=ids).update(status=status, date_updated=timezone.now())
 
-class OrderLine(models.Model):
+            order_ids = {order_id for line_id, order_id in lines}
+            done = Order.objects.filter(id__in=order_ids).exclude(lines__status__lt=OrderLine.SENT)
+            for order in done.exclude(status=Order.DONE):
+                logger.info("All lines for order %d have been processed. Marking as done.", order.id,)
+                order.status = Order.DONE
+                order.save()
+
+            orderlines_status_changed.send(sender=OrderLine, lines=lines, status=status)
+        return ids
+
+
+class OrderLine(StatusTrackingMixin, models.Model):
     NEW = 10
     PROCESSING = 20
     SENT = 30
@@ -231,7 +285,69 @@ class OrderLine(models.Model):
         (SENT, 'Sent'),
         (CANCELLED, 'Cancelled'),
     )
+    TRANSITIONS = {
+        NEW: (PROCESSING, SENT, CANCELLED),
+        PROCESSING: (SENT, CANCELLED),
+    }
 
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='lines')
     product = models.ForeignKey(Product, on_delete=models.PROTECT)
     status = models.IntegerField(choices=STATUSES, default=NEW)
+    date_updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = OrderLineQuerySet.as_manager()
+
+
+class OrderDailyRollup(models.Model):
+    """Orders added on one day per billing country and current status, and
+    the value of their lines. Kept up to date by main.rollups."""
+    day = models.DateField()
+    country = models.CharField(max_length=3)
+    status = models.IntegerField(choices=Order.STATUSES)
+    orders = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["day", "country", "status"], name="orderdailyrollup_unique"),
+        ]
+
+
+class ProductDailySales(models.Model):
+    """Units of a product ordered on one day. Kept up to date by
+    main.rollups."""
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    quantity = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["day", "product"], name="productdailysales_unique"),
+        ]
+
+
+class Tombstone(models.Model):
+    """Marks a deleted order or order line so that incremental API clients
+    can drop their copy."""
+    ORDER = "order"
+    ORDERLINE = "orderline"
+    MODELS = ((ORDER, "Order"), (ORDERLINE, "Order line"))
+
+    model = models.CharField(max_length=16, choices=MODELS)
+    object_id = models.PositiveIntegerField()
+    date_deleted = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class ChatMessage(models.Model):
+    """A message sent in an order's customer service chat. Written in
+    batches by main.chat_history, never on the websocket send path."""
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='chat_messages')
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
+    username = models.CharField(max_length=150)
+    message = models.TextField()
+    date_added = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["order", "-id"], name="chatmessage_order_id_idx"),
+        ]
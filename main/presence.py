@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import math
+import time
+import weakref
+
+from django.conf import settings
+
+from . import metrics, redis_pool
+
+logger = logging.getLogger(__name__)
+
+ROOMS_KEY = "presence:rooms"
+# Employees online for chat assignment, see main.assignment. It is not a
+# chat, so it is left out of ROOMS_KEY and active_rooms.
+LOBBY = "customer-service-employees"
+
+# Heartbeats waiting for the next flush, keyed by (room, member) so that
+# repeated heartbeats from one socket between two flushes cost one write.
+_pending = {}
+_flushers = weakref.WeakKeyDictionary()
+
+
+def room_key(room):
+    return "presence:room:%s" % room
+
+
+def record_heartbeat(room, member, seen=None):
+    """Marks ``member`` as present in ``room``. The write is buffered and
+    sent to Redis with every other heartbeat of this worker on the next
+    flush, at most ``CHAT_PRESENCE_FLUSH_INTERVAL`` seconds later."""
+    _pending[(room, member)] = time.time() if seen is None else seen
+    loop = asyncio.get_running_loop()
+    flusher = _flushers.get(loop)
+    if flusher is None or flusher.done():
+        _flushers[loop] = loop.create_task(_flush_later())
+
+
+async def _flush_later():
+    await asyncio.sleep(settings.CHAT_PRESENCE_FLUSH_INTERVAL)
+    try:
+        await flush()
+    except Exception:
+        # Presence is refreshed by the next heartbeat, so a failed batch is
+        # dropped rather than retried.
+        logger.exception("Could not flush chat presence")
+
+
+async def flush():
+    """Writes every buffered heartbeat in one pipelined round trip and
+    returns the number written."""
+    if not _pending:
+        return 0
+    batch = dict(_pending)
+    _pending.clear()
+
+    timeout = settings.CHAT_PRESENCE_TIMEOUT
+    latest = {}
+    with metrics.chat_presence_flush_seconds.time():
+        redis = await redis_pool.get_redis()
+        pipe = redis.pipeline()
+        for (room, member), seen in batch.items():
+            pipe.zadd(room_key(room), seen, member)
+            latest[room] = max(latest.get(room, seen), seen)
+        for room, seen in latest.items():
+            pipe.zremrangebyscore(room_key(room), max=seen - timeout)
+            pipe.expire(room_key(room), math.ceil(timeout))
+            if room != LOBBY:
+                pipe.zadd(ROOMS_KEY, seen, room)
+        await pipe.execute()
+    metrics.chat_heartbeat_writes.inc(len(batch))
+    return len(batch)
+
+
+async def members(room, now=None):
+    """Returns the members of ``room`` seen within ``CHAT_PRESENCE_TIMEOUT``."""
+    cutoff = (time.time() if now is None else now) - settings.CHAT_PRESENCE_TIMEOUT
+    redis = await redis_pool.get_redis()
+    return await redis.zrangebyscore(room_key(room), min=cutoff, encoding="utf-8")
+
+
+async def forget(room, member):
+    """Removes ``member`` from ``room`` now rather than on timeout."""
+    _pending.pop((room, member), None)
+    redis = await redis_pool.get_redis()
+    await redis.zrem(room_key(room), member)
+
+
+async def active_rooms(now=None):
+    """Returns the rooms with at least one member seen within
+    ``CHAT_PRESENCE_TIMEOUT``, and those members with their last-seen time."""
+    cutoff = (time.time() if now is None else now) - settings.CHAT_PRESENCE_TIMEOUT
+    redis = await redis_pool.get_redis()
+    rooms = await redis.zrangebyscore(ROOMS_KEY, min=cutoff, encoding="utf-8")
+
+    pipe = redis.pipeline()
+    for room in rooms:
+        pipe.zrangebyscore(room_key(room), min=cutoff, withscores=True, encoding="utf-8")
+    pipe.zremrangebyscore(ROOMS_KEY, max=cutoff)
+    *members, _ = await pipe.execute()
+
+    return [
+        {
+            "room": room,
+            "participants": [
+                {"member": member, "last_seen": seen}
+                for member, seen in room_members
+            ],
+        }
+        for room, room_members in zip(rooms, members)
+        if room_members
+    ]
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import weakref
+
+import aioredis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# One pool per event loop, which in a Channels worker means one per process.
+# Each entry is the task creating the pool, so that concurrent first callers
+# wait on the same pool instead of opening one each.
+_pools = weakref.WeakKeyDictionary()
+
+_consumer_counts = {"opened": 0, "closed": 0, "leaked": 0}
+
+
+def _pool_usable(task):
+    if not task.done():
+        return True
+    if task.cancelled() or task.exception() is not None:
+        return False
+    return not task.result().closed
+
+
+async def get_redis():
+    """Return the Redis client shared by every consumer in this worker,
+    creating its connection pool on first use."""
+    loop = asyncio.get_running_loop()
+    task = _pools.get(loop)
+    if task is None or not _pool_usable(task):
+        task = loop.create_task(aioredis.create_redis_pool(
+            settings.CHAT_REDIS_URL,
+            minsize=settings.CHAT_REDIS_POOL_MINSIZE,
+            maxsize=settings.CHAT_REDIS_POOL_MAXSIZE,
+        ))
+        _pools[loop] = task
+    return await asyncio.shield(task)
+
+
+async def close_pool():
+    task = _pools.pop(asyncio.get_running_loop(), None)
+    if task is not None and _pool_usable(task):
+        redis = await task
+        redis.close()
+        await redis.wait_closed()
+
+
+def _leaked(owner_repr):
+    _consumer_counts["leaked"] += 1
+    logger.warning("%s was collected without being closed", owner_repr)
+
+
+class ConsumerLifetime:
+    """Tracks that a consumer using the shared pool is closed.
+
+    This counts consumers, not connections: commands borrow a pooled
+    connection only while they run, which pool_stats reports separately.
+    A consumer collected without calling ``close`` shows up as leaked,
+    along with whatever else it held on to."""
+
+    def __init__(self, owner):
+        self._finalizer = weakref.finalize(owner, _leaked, repr(owner))
+        _consumer_counts["opened"] += 1
+
+    @property
+    def closed(self):
+        return not self._finalizer.alive
+
+    def close(self):
+        if self._finalizer.detach() is not None:
+            _consumer_counts["closed"] += 1
+
+
+def pool_stats():
+    pools = [
+        task.result() for task in list(_pools.values())
+        if task.done() and _pool_usable(task)
+    ]
+    opened = _consumer_counts["opened"]
+    closed = _consumer_counts["closed"]
+    leaked = _consumer_counts["leaked"]
+    connections = sum(redis.connection.size for redis in pools)
+    free = sum(redis.connection.freesize for redis in pools)
+    return {
+        "pools": len(pools),
+        "connections": connections,
+        "free_connections": free,
+        "connections_in_use": connections - free,
+        "max_connections": sum(redis.connection.maxsize for redis in pools),
+        "consumers_opened": opened,
+        "consumers_closed": closed,
+        "consumers_leaked": leaked,
+        "consumers_open": opened - closed - leaked,
+    }
@@ -0,0 +1,80 @@
+import csv
+import json
+
+import msgpack
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework import renderers
+
+
+class Echo:
+    """A file-like object that hands back what is written to it, so that
+    csv.writer can be used to produce streamed lines."""
+
+    def write(self, value):
+        return value
+
+
+def stream_ndjson(fields, rows, chunk_size=1000):
+    encoder = DjangoJSONEncoder(separators=(",", ":"))
+    lines = []
+    for row in rows:
+        lines.append(encoder.encode(dict(zip(fields, row))))
+        if len(lines) >= chunk_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def stream_csv(fields, rows, chunk_size=1000):
+    writer = csv.writer(Echo())
+    lines = [writer.writerow(fields)]
+    for row in rows:
+        lines.append(writer.writerow(row))
+        if len(lines) >= chunk_size:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+class NDJSONRenderer(renderers.BaseRenderer):
+    """Renders non-streamed responses, such as errors, for views that stream
+    newline delimited JSON."""
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        rows = data if isinstance(data, list) else [data]
+        return "".join(json.dumps(row, cls=DjangoJSONEncoder) + "\n" for row in rows).encode(self.charset)
+
+
+class CSVRenderer(renderers.BaseRenderer):
+    """Renders non-streamed responses, such as errors, for views that stream
+    CSV."""
+    media_type = "text/csv"
+    format = "csv"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        rows = data if isinstance(data, list) else [data]
+        fields = list(rows[0]) if rows else []
+        content = stream_csv(fields, ([row.get(f) for f in fields] for row in rows))
+        return "".join(content).encode(self.charset)
+
+
+class MessagePackRenderer(renderers.BaseRenderer):
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack.packb(data, use_bin_type=True, default=str)
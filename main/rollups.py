@@ -0,0 +1,190 @@
+"""Keeps OrderDailyRollup and ProductDailySales in step with orders, so
+that reports never scan the order tables.
+
+Every change is a delta applied with one UPDATE, which is safe under
+concurrent writers. ``rebuild`` recomputes rows from the orders, for history
+and for changes that bypass signals such as raw SQL or loaddata; deltas to
+rows that were never created, as for orders loaded that way, are lost."""
+import collections
+import heapq
+import logging
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Count, DecimalField, F, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+TOP_PRODUCTS = 10
+TOP_PRODUCTS_VERSION_KEY = "top-products:version"
+
+
+def local_day(value):
+    if timezone.is_naive(value):
+        return value.date()
+    return timezone.localdate(value)
+
+
+def order_day(order):
+    return local_day(order.date_added)
+
+
+def add(day, country, status, orders=0, revenue=Decimal(0)):
+    models.OrderDailyRollup.objects.filter(day=day, country=country, status=status).update(
+        orders=F("orders") + orders, revenue=F("revenue") + revenue)
+
+
+def create_rows(day, country):
+    """Creates the rows of every status for ``day`` and ``country``, so that
+    later changes are a plain UPDATE."""
+    models.OrderDailyRollup.objects.bulk_create(
+        [models.OrderDailyRollup(day=day, country=country, status=status)
+         for status, _ in models.Order.STATUSES],
+        ignore_conflicts=True,
+    )
+
+
+def move(day, country, order, old_status, new_status):
+    """Moves ``order`` between two status rows with one UPDATE, reading the
+    value of its lines in the same statement."""
+    revenue = Coalesce(
+        Subquery(
+            models.OrderLine.objects.filter(order=order.pk).order_by()
+            .values("order").annotate(total=Sum("product__price")).values("total")
+        ),
+        Value(Decimal(0)),
+        output_field=DecimalField(),
+    )
+    sign = Case(When(status=old_status, then=Value(-1)), default=Value(1))
+    models.OrderDailyRollup.objects.filter(
+        day=day, country=country, status__in=[old_status, new_status]
+    ).update(orders=F("orders") + sign, revenue=F("revenue") + sign * revenue)
+
+
+def order_saved(order, created):
+    day = order_day(order)
+    if created:
+        create_rows(day, order.billing_country)
+        add(day, order.billing_country, order.status, orders=1)
+    elif order.status_changed:
+        move(day, order.billing_country, order, order._loaded_status, order.status)
+
+
+def order_deleted(order):
+    # Its lines were deleted, and their revenue taken off, just before
+    add(order_day(order), order.billing_country, order.status, orders=-1)
+
+
+def orderline_changed(line, sign):
+    order = line.order
+    day = order_day(order)
+    add(day, order.billing_country, order.status, revenue=sign * line.product.price)
+
+    if sign > 0:
+        models.ProductDailySales.objects.bulk_create(
+            [models.ProductDailySales(day=day, product_id=line.product_id)], ignore_conflicts=True)
+    models.ProductDailySales.objects.filter(day=day, product_id=line.product_id).update(
+        quantity=F("quantity") + sign)
+    if day != local_day(timezone.now()):
+        # Only today's sales are added to the cached totals
+        invalidate_top_products()
+
+
+def get_top_products_version():
+    version = cache.get(TOP_PRODUCTS_VERSION_KEY)
+    if version is None:
+        cache.add(TOP_PRODUCTS_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(TOP_PRODUCTS_VERSION_KEY)
+    return version
+
+
+def invalidate_top_products():
+    try:
+        cache.incr(TOP_PRODUCTS_VERSION_KEY)
+    except ValueError:
+        get_top_products_version()
+
+
+def top_products(days, limit=TOP_PRODUCTS):
+    """Returns (product name, units sold) of the ``limit`` best selling
+    products of the last ``days`` days, today included, best first.
+
+    The totals of the days before today are cached until tomorrow; today's
+    counters are added on every call."""
+    today = local_day(timezone.now())
+    key = "top-products:%s:%d:%s" % (get_top_products_version(), days, today.isoformat())
+    totals = cache.get(key)
+    if totals is None:
+        totals = dict(
+            models.ProductDailySales.objects.filter(day__gt=today - timedelta(days=days), day__lt=today)
+            .values("product").annotate(total=Sum("quantity")).values_list("product", "total")
+            .order_by()
+        )
+        cache.set(key, totals, 24 * 60 * 60)
+
+    totals = collections.Counter(totals)
+    totals.update(dict(
+        models.ProductDailySales.objects.filter(day=today).values_list("product", "quantity")))
+    winners = heapq.nsmallest(
+        limit, ((-quantity, product) for product, quantity in totals.items() if quantity > 0))
+    names = models.Product.objects.only("name").in_bulk([product for _, product in winners])
+    return [(names[product].name, -quantity) for quantity, product in winners]
+
+
+@transaction.atomic
+def rebuild(since=None):
+    """Recomputes the rollups from the orders, for every day or the days
+    from ``since`` on. Returns the number of rows written."""
+    orders = models.Order.objects.all()
+    lines = models.OrderLine.objects.all()
+    rollups = models.OrderDailyRollup.objects.all()
+    sales = models.ProductDailySales.objects.all()
+    if since is not None:
+        start = timezone.make_aware(timezone.datetime.combine(since, timezone.datetime.min.time()))
+        orders = orders.filter(date_added__gte=start)
+        lines = lines.filter(order__date_added__gte=start)
+        rollups = rollups.filter(day__gte=since)
+        sales = sales.filter(day__gte=since)
+
+    order_rows = (
+        orders.annotate(day=TruncDate("date_added"))
+        .values("day", "billing_country", "status")
+        .annotate(
+            order_count=Count("id", distinct=True),
+            total=Coalesce(
+                Sum("lines__product__price"), Value(Decimal(0)), output_field=DecimalField()),
+        )
+        .order_by()
+    )
+    # Every status has a row, as create_rows would have made
+    totals = {}
+    for row in order_rows.iterator():
+        for status, _ in models.Order.STATUSES:
+            totals.setdefault((row["day"], row["billing_country"], status), (0, Decimal(0)))
+        totals[row["day"], row["billing_country"], row["status"]] = (row["order_count"], row["total"])
+
+    sales_rows = (
+        lines.annotate(day=TruncDate("order__date_added"))
+        .values("day", "product").annotate(quantity=Count("id")).order_by()
+    )
+
+    rollups.delete()
+    sales.delete()
+    created = models.OrderDailyRollup.objects.bulk_create(
+        models.OrderDailyRollup(day=day, country=country, status=status, orders=count, revenue=revenue)
+        for (day, country, status), (count, revenue) in totals.items()
+    )
+    created += models.ProductDailySales.objects.bulk_create(
+        models.ProductDailySales(day=row["day"], product_id=row["product"], quantity=row["quantity"])
+        for row in sales_rows.iterator()
+    )
+    transaction.on_commit(invalidate_top_products)
+    logger.info("Rebuilt %d order and product rollups", len(created))
+    return len(created)
@@ -0,0 +1,9 @@
+from django.urls import path
+
+from . import consumers
+
+websocket_urlpatterns = [
+    path("ws/customer-service/<int:order_id>/", consumers.ChatConsumer.as_asgi()),
+    path("ws/customer-service/assignments/", consumers.EmployeeLobbyConsumer.as_asgi()),
+    path("ws/order-dashboard/", consumers.OrderDashboardConsumer.as_asgi()),
+]
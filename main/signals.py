@@ -3,11 +3,15 @@ from io import BytesIO
 
 from django.contrib.auth.signals import user_logged_in
 from django.core.files.base import ContentFile
-from django.db.models.signals import post_save, pre_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from PIL import Image
 
-from .models import Basket, Order, OrderLine, ProductImage
+from . import dashboard, invoices, rollups
+from .endpoints import invalidate_api_cache
+from .models import (Basket, Order, OrderLine, Product, ProductImage,
+                     Tombstone, orderlines_status_changed)
 
 THUMBNAIL_SIZE = (300, 300)
 logger = logging.getLogger(__name__)
@@ -56,3 +60,81 @@ def orderline_to_order_status(sender, instance, **kwargs):
         logger.info("All lines for order %d have been processed. Marking as done.", instance.order.id,)
         instance.order.status = Order.DONE
         instance.order.save()
+
+
+@receiver(post_save, sender=Order)
+def touch_orderlines_on_status_change(sender, instance, created, raw=False, **kwargs):
+    # Lines enter and leave the API with their order's status, so incremental
+    # clients filtering on the lines' date_updated must see them change too.
+    if not created and not raw and instance.status_changed:
+        instance.lines.update(date_updated=instance.date_updated)
+
+
+@receiver(post_delete, sender=Order)
+@receiver(post_delete, sender=OrderLine)
+def record_tombstone(sender, instance, **kwargs):
+    Tombstone.objects.create(model=sender._meta.model_name, object_id=instance.id)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_save, sender=OrderLine)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Order)
+@receiver(post_delete, sender=OrderLine)
+@receiver(post_delete, sender=Product)
+def invalidate_order_api_cache(sender, instance, **kwargs):
+    # On commit, so that a response cached by another request before this
+    # transaction commits does not survive.
+    transaction.on_commit(invalidate_api_cache)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_save, sender=OrderLine)
+def publish_order_update(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created or instance.status_changed:
+        update = dashboard.order_update(instance, created)
+        transaction.on_commit(lambda: dashboard.publish([update]))
+
+
+@receiver(orderlines_status_changed, sender=OrderLine)
+def publish_orderline_status_changes(sender, lines, status, **kwargs):
+    updates = dashboard.orderline_status_updates(lines, status, dict(OrderLine.STATUSES)[status])
+    transaction.on_commit(lambda: dashboard.publish(updates))
+
+
+@receiver(post_save, sender=Order)
+def update_order_rollup(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        rollups.order_saved(instance, created)
+
+
+@receiver(post_delete, sender=Order)
+def remove_order_from_rollup(sender, instance, **kwargs):
+    rollups.order_deleted(instance)
+
+
+@receiver(post_save, sender=OrderLine)
+def add_orderline_to_rollup(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        rollups.orderline_changed(instance, 1)
+
+
+@receiver(post_delete, sender=OrderLine)
+def remove_orderline_from_rollup(sender, instance, **kwargs):
+    rollups.orderline_changed(instance, -1)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def invalidate_order_invoice(sender, instance, **kwargs):
+    # Deleting clears the instance's pk before the transaction commits
+    order_id = instance.pk
+    transaction.on_commit(lambda: invoices.invalidate(order_id))
+
+
+@receiver(post_save, sender=OrderLine)
+@receiver(post_delete, sender=OrderLine)
+def invalidate_orderline_invoice(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invoices.invalidate(instance.order_id))
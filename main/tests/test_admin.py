@@ -1,11 +1,26 @@
-from datetime import datetime
+import io
+import os
+import tempfile
+import zipfile
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
 from decimal import Decimal
-from unittest.mock import patch
+from unittest.mock import Mock, patch
+from urllib.parse import urlencode
 
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from channels.testing import HttpCommunicator
+from django.conf import settings
+from django.db import connection
+from django.middleware.csrf import _get_new_csrf_string
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
-from main import factories, models
+from main import factories, invoices, models, rollups
+from main.admin import EstimatedCountPaginator
 
 
 class TestAdminViews(TestCase):
@@ -32,13 +47,59 @@ class TestAdminViews(TestCase):
 
         self.assertEqual(response.status_code, 200)
 
-        data = dict(
-            zip(
-                response.context["labels"],
-                response.context["values"],
-            )
-        )
-        self.assertEqual(data, {"B": 3, "C": 2, "A": 6})
+        self.assertEqual(response.context["labels"], ["A", "B", "C"])
+        self.assertEqual(response.context["values"], [6, 3, 2])
+
+    def test_top_products_cache_past_days_and_add_today(self):
+        products = factories.ProductFactory.create_batch(3)
+        old_order = factories.OrderFactory()
+        models.Order.objects.filter(id=old_order.id).update(date_added=timezone.now() - timedelta(days=2))
+        old_order.refresh_from_db()
+        factories.OrderLineFactory.create_batch(3, order=old_order, product=products[0])
+        factories.OrderLineFactory.create_batch(2, order=old_order, product=products[1])
+        self.assertEqual(rollups.top_products(30, limit=2), [(products[0].name, 3), (products[1].name, 2)])
+
+        # Past totals come from the cache; today's counters and the
+        # winners' names are read
+        today = factories.OrderFactory()
+        factories.OrderLineFactory.create_batch(4, order=today, product=products[2])
+        with self.assertNumQueries(2):
+            top = rollups.top_products(30, limit=2)
+        self.assertEqual(top, [(products[2].name, 4), (products[0].name, 3)])
+
+        # Changing a past day drops the cached totals
+        old_order.lines.filter(product=products[0]).first().delete()
+        self.assertEqual(rollups.top_products(30, limit=2), [(products[2].name, 4), (products[0].name, 2)])
+        self.assertEqual(rollups.top_products(1), [(products[2].name, 4)])
+
+    def test_orders_per_day_reads_the_rollup(self):
+        product = factories.ProductFactory(price=Decimal("10.00"))
+        orders = factories.OrderFactory.create_batch(3, billing_country="uk")
+        factories.OrderFactory(billing_country="it")
+        for order in orders:
+            factories.OrderLineFactory.create_batch(2, order=order, product=product)
+        orders[0].status = models.Order.PAID
+        orders[0].save()
+        orders[1].lines.first().delete()
+        orders[2].delete()
+
+        # Rows for every status are created with a day's first order
+        rollup = models.OrderDailyRollup.objects.exclude(orders=0).order_by("country", "status")
+        incremental = list(rollup.values_list("country", "status", "orders", "revenue"))
+        self.assertEqual(incremental, [
+            ("it", models.Order.NEW, 1, Decimal("0.00")),
+            ("uk", models.Order.NEW, 1, Decimal("10.00")),
+            ("uk", models.Order.PAID, 1, Decimal("20.00")),
+        ])
+        rollups.rebuild()
+        self.assertEqual(list(rollup.values_list("country", "status", "orders", "revenue")), incremental)
+
+        user = models.User.objects.create_superuser("user2", "pw432joij")
+        self.client.force_login(user)
+        with self.assertNumQueries(3):
+            # Session, user and the rollup
+            response = self.client.get(reverse("admin:orders_per_day"))
+        self.assertEqual(response.context["values"], [3])
 
     def test_invoice_renders_exactly_as_expected(self):
         products = [
@@ -74,8 +135,218 @@ class TestAdminViews(TestCase):
             response = self.client.get(reverse("admin:invoice", kwargs={"order_id": order.id}),
                                        {"format": "pdf"})
             self.assertEqual(response.status_code, 200)
-            content = response.content
+            content = b"".join(response.streaming_content)
 
             with open("main/fixtures/invoice_test_order.pdf", "rb") as fixture:
                 expected_content = fixture.read()
             self.assertEqual(content, expected_content)
+
+    def invoice_renders(self, html):
+        return [c for c in html.call_args_list if "Invoice number" in c.kwargs.get("string", "")]
+
+    def test_invoice_pdfs_are_rendered_once_per_content(self):
+        product = factories.ProductFactory(price=Decimal("10.00"))
+        order = factories.OrderFactory()
+        factories.OrderLineFactory(order=order, product=product)
+        user = models.User.objects.create_superuser("user2", "pw432joij")
+        self.client.force_login(user)
+        url = reverse("admin:invoice", kwargs={"order_id": order.id})
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                self.settings(INVOICE_CACHE_DIR=cache_dir, INVOICE_RENDER_WORKERS=0), \
+                patch("main.invoices.HTML") as html:
+            html.return_value.write_pdf.return_value = b"%PDF-1"
+            first = self.client.get(url, {"format": "pdf"})
+            second = self.client.get(url, {"format": "pdf"})
+            self.assertEqual(b"".join(first.streaming_content), b"%PDF-1")
+            self.assertEqual(b"".join(second.streaming_content), b"%PDF-1")
+            self.assertEqual(len(self.invoice_renders(html)), 1)
+            self.assertEqual(first["Content-Type"], "application/pdf")
+
+            html.return_value.write_pdf.return_value = b"%PDF-2"
+            with self.captureOnCommitCallbacks(execute=True):
+                factories.OrderLineFactory(order=order, product=product)
+            self.assertFalse(os.path.exists(os.path.join(cache_dir, str(order.id))))
+            third = self.client.get(url, {"format": "pdf"})
+            self.assertEqual(b"".join(third.streaming_content), b"%PDF-2")
+            self.assertEqual(len(os.listdir(os.path.join(cache_dir, str(order.id)))), 1)
+
+    def test_slow_invoices_are_stored_when_done(self):
+        order = factories.OrderFactory()
+        user = models.User.objects.create_superuser("user2", "pw432joij")
+        self.client.force_login(user)
+        url = reverse("admin:invoice", kwargs={"order_id": order.id})
+        render = Future()
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                self.settings(INVOICE_CACHE_DIR=cache_dir, INVOICE_RENDER_TIMEOUT=0.01), \
+                patch("main.invoices.submit_render", return_value=render) as submit:
+            response = self.client.get(url, {"format": "pdf"})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response["Retry-After"], "5")
+
+            render.set_result(b"%PDF-slow")
+            response = self.client.get(url, {"format": "pdf"})
+            self.assertEqual(b"".join(response.streaming_content), b"%PDF-slow")
+            self.assertEqual(submit.call_count, 1)
+
+    def test_a_late_render_does_not_remove_a_newer_pdf(self):
+        order = factories.OrderFactory()
+        late, current = Future(), Future()
+        current.set_result(b"%PDF-current")
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                self.settings(INVOICE_CACHE_DIR=cache_dir, INVOICE_RENDER_TIMEOUT=0.01), \
+                patch("main.invoices.submit_render", side_effect=[late, current]):
+            with self.assertRaises(invoices.TimeoutError):
+                invoices.open_invoice_pdf(order, "http://testserver/")
+            with self.settings(INVOICE_TEMPLATE_VERSION="next"):
+                invoices.open_invoice_pdf(order, "http://testserver/").close()
+                late.set_result(b"%PDF-late")
+                with invoices.open_invoice_pdf(order, "http://testserver/") as invoice:
+                    self.assertEqual(invoice.read(), b"%PDF-current")
+            self.assertEqual(len(os.listdir(os.path.join(cache_dir, str(order.id)))), 2)
+
+    def test_renders_lost_with_a_crashed_process_are_retried_in_a_new_pool(self):
+        order = factories.OrderFactory()
+        lost, rendered = Future(), Future()
+        lost.set_exception(BrokenProcessPool("A rendering process died"))
+        rendered.set_result(b"%PDF-retried")
+        pool = Mock()
+        # The pool refuses new work once broken, until it is replaced
+        pool.submit.side_effect = [lost, BrokenProcessPool("Broken"), rendered]
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                self.settings(INVOICE_CACHE_DIR=cache_dir, INVOICE_RENDER_WORKERS=1), \
+                patch("main.invoices.render_pool", return_value=pool), \
+                patch("main.invoices.shutdown_pool") as shutdown_pool:
+            with invoices.open_invoice_pdf(order, "http://testserver/") as invoice:
+                self.assertEqual(invoice.read(), b"%PDF-retried")
+
+        self.assertEqual(pool.submit.call_count, 3)
+        shutdown_pool.assert_called_once_with()
+
+    def test_invoices_of_selected_orders_are_streamed_as_a_zip(self):
+        orders = factories.OrderFactory.create_batch(5)
+        for order in orders:
+            factories.OrderLineFactory(order=order, product=factories.ProductFactory())
+        user = models.User.objects.create_superuser("user2", "pw432joij")
+        self.client.force_login(user)
+        # The rendering processes must be started with HTML patched
+        invoices.shutdown_pool()
+        self.addCleanup(invoices.shutdown_pool)
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                self.settings(INVOICE_CACHE_DIR=cache_dir, INVOICE_RENDER_WORKERS=2), \
+                patch("main.invoices.HTML") as html:
+            html.return_value.write_pdf.return_value = b"%PDF-cached"
+            with self.settings(INVOICE_RENDER_WORKERS=0):
+                invoices.open_invoice_pdf(orders[0], "http://testserver/").close()
+            html.return_value.write_pdf.return_value = b"%PDF-bulk"
+
+            response = self.client.post(reverse("admin:main_order_changelist"), {
+                "action": "download_invoices",
+                "_selected_action": [order.id for order in orders[:4]],
+            })
+            self.assertTrue(response.streaming)
+            self.assertEqual(response["Content-Type"], "application/zip")
+            archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+
+        self.assertEqual(archive.namelist(), ["invoice-BT%d.pdf" % order.id for order in orders[:4]])
+        self.assertEqual(archive.read("invoice-BT%d.pdf" % orders[0].id), b"%PDF-cached")
+        self.assertEqual(archive.read("invoice-BT%d.pdf" % orders[3].id), b"%PDF-bulk")
+
+    def test_changelists_use_a_fixed_number_of_queries(self):
+        superuser = models.User.objects.create_superuser("user2", "pw432joij")
+        self.client.force_login(superuser)
+        product = factories.ProductFactory()
+        users = iter(models.User.objects.create_user("user%d@a.com" % i, "pw432joij") for i in range(100))
+
+        def add_rows():
+            user = next(users)
+            factories.OrderFactory(user=user)
+            factories.AddressFactory(user=user, country="uk")
+            basket = models.Basket.objects.create(user=user)
+            models.BasketLine.objects.create(basket=basket, product=product, quantity=2)
+            models.BasketLine.objects.create(basket=basket, product=product, quantity=3)
+            models.ProductImage.objects.bulk_create([
+                models.ProductImage(product=factories.ProductFactory(), image="image.jpg")
+            ])
+
+        changelists = [
+            "admin:main_order_changelist",
+            "admin:main_address_changelist",
+            "admin:main_basket_changelist",
+            "admin:main_productimage_changelist",
+            "central-office-admin:main_order_changelist",
+        ]
+        add_rows()
+        queries = {}
+        for name in changelists:
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(self.client.get(reverse(name)).status_code, 200)
+            queries[name] = len(ctx)
+
+        for _ in range(3):
+            add_rows()
+        for name in changelists:
+            with self.assertNumQueries(queries[name]):
+                response = self.client.get(reverse(name))
+        self.assertContains(response, "user3@a.com")
+
+        response = self.client.get(reverse("admin:main_basket_changelist"))
+        self.assertEqual([basket.item_count for basket in response.context["cl"].result_list], [5] * 4)
+
+    def test_unfiltered_changelists_of_large_tables_use_the_estimate(self):
+        factories.OrderFactory.create_batch(3)
+        orders = models.Order.objects.order_by("id")
+        with patch.object(EstimatedCountPaginator, "estimated_count", return_value=None):
+            self.assertEqual(EstimatedCountPaginator(orders, 100).count, 3)
+        with patch.object(EstimatedCountPaginator, "estimated_count", return_value=10):
+            self.assertEqual(EstimatedCountPaginator(orders, 100).count, 3)
+        with patch.object(EstimatedCountPaginator, "estimated_count", return_value=10 ** 6):
+            self.assertEqual(EstimatedCountPaginator(orders, 100).count, 10 ** 6)
+        # SQLite keeps no estimate
+        self.assertIsNone(EstimatedCountPaginator(orders, 100).estimated_count())
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class TestAdminASGI(TransactionTestCase):
+    """Admin downloads through the deployed ASGI application. The body is
+    built in another thread, so the rows it reads must be committed."""
+
+    def test_invoices_zip_streams_through_the_asgi_application(self):
+        from booktime.routing import application
+
+        orders = factories.OrderFactory.create_batch(3)
+        for order in orders:
+            factories.OrderLineFactory(order=order, product=factories.ProductFactory())
+        self.client.force_login(models.User.objects.create_superuser("user2", "pw432joij"))
+        csrf_token = _get_new_csrf_string()
+        cookie = "%s=%s; %s=%s" % (
+            settings.SESSION_COOKIE_NAME, self.client.cookies[settings.SESSION_COOKIE_NAME].value,
+            settings.CSRF_COOKIE_NAME, csrf_token,
+        )
+        body = urlencode({
+            "action": "download_invoices",
+            "_selected_action": [order.id for order in orders],
+            "csrfmiddlewaretoken": csrf_token,
+        }, doseq=True).encode()
+        communicator = HttpCommunicator(
+            application, "POST", reverse("admin:main_order_changelist"), body=body, headers=[
+                (b"host", b"testserver"),
+                (b"cookie", cookie.encode()),
+                (b"content-type", b"application/x-www-form-urlencoded"),
+            ])
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                self.settings(INVOICE_CACHE_DIR=cache_dir, INVOICE_RENDER_WORKERS=0), \
+                patch("main.invoices.HTML") as html:
+            html.return_value.write_pdf.return_value = b"%PDF-asgi"
+            response = async_to_sync(communicator.get_response)()
+
+        self.assertEqual(response["status"], 200)
+        self.assertIn((b"Content-Type", b"application/zip"), response["headers"])
+        archive = zipfile.ZipFile(io.BytesIO(response["body"]))
+        self.assertEqual(archive.namelist(), ["invoice-BT%d.pdf" % order.id for order in orders])
+        self.assertEqual(archive.read("invoice-BT%d.pdf" % orders[2].id), b"%PDF-asgi")
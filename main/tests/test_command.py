@@ -1,8 +1,11 @@
+import json
 import tempfile
 from io import StringIO
+from unittest import mock
 
 from django.conf import settings
 from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase, override_settings
 
 from main import models
@@ -25,3 +28,19 @@ class TestImport(TestCase):
         self.assertEqual(models.Product.objects.count(), 3)
         self.assertEqual(models.ProductTag.objects.count(), 6)
         self.assertEqual(models.ProductImage.objects.count(), 3)
+
+
+class TestBenchmarkImport(TestCase):
+    def test_benchmark_import_reports_json(self):
+        out = StringIO()
+        # The test database already is a scratch database
+        with mock.patch.object(connection.creation, "create_test_db"), \
+                mock.patch.object(connection.creation, "destroy_test_db"):
+            call_command("benchmark_import", "--rows=5", "--images=2", "--image-size=8", stdout=out)
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report), {"parameters", "environment", "results"})
+        self.assertEqual(report["parameters"]["rows"], 5)
+        self.assertGreater(report["results"]["products"], 0)
+        self.assertIn("queries_per_row", report["results"])
+        self.assertIn("peak_rss_kb", report["results"])
@@ -0,0 +1,707 @@
+import asyncio
+import gc
+from decimal import Decimal
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import OperationalError, connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from main import assignment, chat_history, metrics, models, presence, redis_pool
+from main.consumers import ChatConsumer, Outbox
+
+
+class FakeRedis:
+    closed = False
+
+    def __init__(self):
+        self.connection = mock.Mock(size=1, freesize=1, maxsize=20)
+
+
+class FakeSortedSets:
+    """Just enough of aioredis' sorted set commands for the presence code."""
+
+    def __init__(self):
+        self.sets = {}
+        self.round_trips = 0
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    async def zrangebyscore(self, *args, **kwargs):
+        return self.run("zrangebyscore", *args, **kwargs)
+
+    async def zrem(self, *args, **kwargs):
+        return self.run("zrem", *args, **kwargs)
+
+    def run(self, name, *args, **kwargs):
+        return getattr(self, "_" + name)(*args, **kwargs)
+
+    def _zadd(self, key, score, member):
+        self.sets.setdefault(key, {})[member] = score
+
+    def _zrangebyscore(self, key, min=float("-inf"), withscores=False, encoding=None):
+        members = sorted(self.sets.get(key, {}).items(), key=lambda item: item[1])
+        members = [(member, score) for member, score in members if score >= min]
+        return members if withscores else [member for member, _ in members]
+
+    def _zremrangebyscore(self, key, max=float("inf")):
+        members = self.sets.get(key, {})
+        for member in [m for m, score in members.items() if score <= max]:
+            del members[member]
+
+    def _zrem(self, key, member):
+        self.sets.get(key, {}).pop(member, None)
+
+    def _expire(self, key, seconds):
+        pass
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    async def execute(self):
+        self.redis.round_trips += 1
+        return [self.redis.run(name, *args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class TestPresence(TestCase):
+    def setUp(self):
+        self.redis = FakeSortedSets()
+        patcher = mock.patch("main.redis_pool.get_redis", mock.AsyncMock(return_value=self.redis))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(presence._pending.clear)
+
+    def test_heartbeats_are_flushed_in_one_round_trip(self):
+        async def heartbeats():
+            for second in range(3):
+                for order_id in range(20):
+                    presence.record_heartbeat("customer-service_%d" % order_id, "a@a.com", 100 + second)
+                    presence.record_heartbeat("customer-service_%d" % order_id, "b@b.com", 100 + second)
+            return await presence.flush()
+
+        self.assertEqual(async_to_sync(heartbeats)(), 40)
+        self.assertEqual(self.redis.round_trips, 1)
+        self.assertEqual(self.redis.sets[presence.room_key("customer-service_3")], {"a@a.com": 102, "b@b.com": 102})
+        self.assertEqual(len(self.redis.sets[presence.ROOMS_KEY]), 20)
+
+    def test_active_rooms_skip_members_past_the_timeout(self):
+        async def heartbeats():
+            presence.record_heartbeat("customer-service_1", "a@a.com", 100)
+            presence.record_heartbeat("customer-service_1", "b@b.com", 95)
+            presence.record_heartbeat("customer-service_2", "c@c.com", 80)
+            await presence.flush()
+            return await presence.active_rooms(now=104)
+
+        rooms = async_to_sync(heartbeats)()
+        self.assertEqual(rooms, [{
+            "room": "customer-service_1",
+            "participants": [
+                {"member": "b@b.com", "last_seen": 95},
+                {"member": "a@a.com", "last_seen": 100},
+            ],
+        }])
+        self.assertNotIn("customer-service_2", self.redis.sets[presence.ROOMS_KEY])
+
+    def test_active_rooms_leave_out_the_employee_lobby(self):
+        async def heartbeats():
+            presence.record_heartbeat(assignment.LOBBY, "1", 100)
+            presence.record_heartbeat("customer-service_1", "a@a.com", 100)
+            await presence.flush()
+            return await presence.active_rooms(now=104), await presence.members(assignment.LOBBY, now=104)
+
+        rooms, employees = async_to_sync(heartbeats)()
+        self.assertEqual([room["room"] for room in rooms], ["customer-service_1"])
+        self.assertEqual(employees, ["1"])
+
+    def test_presence_endpoint_is_for_employees(self):
+        user = models.User.objects.create_user("user@a.com", "pw432joij")
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse("chat_presence")).status_code, 403)
+
+        employee = models.User.objects.create_superuser("admin@a.com", "pw432joij")
+        self.client.force_login(employee)
+        with mock.patch("time.time", return_value=100):
+            async_to_sync(self.record_and_flush)("customer-service_1", "user@a.com", 99)
+            response = self.client.get(reverse("chat_presence"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["rooms"][0]["participants"], [
+            {"member": "user@a.com", "last_seen": 99},
+        ])
+
+    async def record_and_flush(self, room, member, seen):
+        presence.record_heartbeat(room, member, seen)
+        await presence.flush()
+
+
+class TestChatHistory(TestCase):
+    def setUp(self):
+        self.user = models.User.objects.create_user("user@a.com", "pw432joij", first_name="John")
+        self.order = models.Order.objects.create(user=self.user)
+        self.addCleanup(chat_history._pending.clear)
+
+    def test_messages_are_written_in_one_batch(self):
+        async def send_and_flush():
+            for i in range(20):
+                chat_history.record_message(self.order.id, self.user, "message %d" % i)
+            return await chat_history.flush()
+
+        with CaptureQueriesContext(connection) as ctx:
+            written = async_to_sync(send_and_flush)()
+        self.assertEqual(written, 20)
+        self.assertEqual(len([q for q in ctx.captured_queries if q["sql"].startswith("INSERT")]), 1)
+        self.assertEqual(self.order.chat_messages.count(), 20)
+
+    def test_a_row_that_cannot_be_written_does_not_hold_up_the_batch(self):
+        async def send_and_flush():
+            chat_history.record_message(self.order.id, self.user, "before")
+            chat_history.record_message(self.order.id, self.user, None)
+            chat_history.record_message(self.order.id, self.user, "after")
+            return await chat_history.flush()
+
+        written = async_to_sync(send_and_flush)()
+        self.assertEqual(written, 2)
+        self.assertEqual(list(self.order.chat_messages.order_by("id").values_list("message", flat=True)),
+                         ["before", "after"])
+        self.assertEqual(chat_history._pending, [])
+
+    def test_failed_writes_are_retried_a_limited_number_of_times(self):
+        async def send_and_flush():
+            chat_history.record_message(self.order.id, self.user, "message")
+            return [await chat_history.flush() for _ in range(settings.CHAT_HISTORY_MAX_ATTEMPTS)]
+
+        with mock.patch.object(models.ChatMessage.objects, "bulk_create", side_effect=OperationalError):
+            written = async_to_sync(send_and_flush)()
+        self.assertEqual(written, [0] * settings.CHAT_HISTORY_MAX_ATTEMPTS)
+        self.assertEqual(chat_history._pending, [])
+
+    def test_replay_includes_unwritten_messages(self):
+        async def send_and_replay():
+            for i in range(4):
+                chat_history.record_message(self.order.id, self.user, "message %d" % i)
+            await chat_history.flush()
+            for i in range(4, 6):
+                chat_history.record_message(str(self.order.id), self.user, "message %d" % i)
+            return await chat_history.recent_messages(self.order.id, 3)
+
+        messages = async_to_sync(send_and_replay)()
+        self.assertEqual([m["message"] for m in messages], ["message 3", "message 4", "message 5"])
+        self.assertEqual(messages[0]["username"], "John")
+
+    def test_history_endpoint_pages_backwards(self):
+        models.ChatMessage.objects.bulk_create(
+            models.ChatMessage(order=self.order, user=self.user, username="John", message="message %d" % i)
+            for i in range(60)
+        )
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("chat_history", kwargs={"order_id": self.order.id}))
+        self.assertEqual(response.status_code, 200)
+        first_page = response.json()
+        self.assertEqual(first_page["results"][0]["message"], "message 59")
+        self.assertEqual(len(first_page["results"]), 50)
+
+        second_page = self.client.get(first_page["next"]).json()
+        self.assertEqual([m["message"] for m in second_page["results"]][-1], "message 0")
+        self.assertEqual(len(second_page["results"]), 10)
+
+    def test_history_endpoint_hides_other_customers_orders(self):
+        other = models.User.objects.create_user("other@a.com", "pw432joij")
+        self.client.force_login(other)
+        response = self.client.get(reverse("chat_history", kwargs={"order_id": self.order.id}))
+        self.assertEqual(response.status_code, 404)
+
+
+class TestOutbox(TestCase):
+    def test_join_and_leave_bursts_are_merged(self):
+        sent = []
+
+        async def flap():
+            async def send_json(frame):
+                sent.append(frame)
+
+            outbox = Outbox(send_json, maxsize=10, presence_delay=0.05)
+            for _ in range(20):
+                outbox.presence_changed("jane@a.com", "Jane", joined=True)
+                outbox.presence_changed("jane@a.com", "Jane", joined=False)
+            outbox.presence_changed("john@a.com", "John", joined=True)
+            outbox.presence_changed("mary@a.com", "Mary", joined=False)
+            await asyncio.sleep(0.1)
+            outbox.close()
+
+        async_to_sync(flap)()
+        self.assertEqual(sent, [{"type": "chat_presence", "joined": ["John"], "left": ["Mary"], "seq": 1}])
+
+    def test_users_with_the_same_name_are_told_apart(self):
+        sent = []
+
+        async def join_and_leave():
+            async def send_json(frame):
+                sent.append(frame)
+
+            outbox = Outbox(send_json, maxsize=10, presence_delay=0.05)
+            outbox.presence_changed("a@a.com", "a@a.com", joined=True)
+            outbox.presence_changed("b@a.com", "b@a.com", joined=False)
+            await asyncio.sleep(0.1)
+            outbox.close()
+
+        async_to_sync(join_and_leave)()
+        self.assertEqual(sent, [{"type": "chat_presence", "joined": ["a@a.com"], "left": ["b@a.com"], "seq": 1}])
+
+    def flood(self, consumer, messages, acknowledge):
+        sent = []
+
+        async def send_json(frame):
+            # Handing a frame to the transport does not wait for the client
+            sent.append(frame)
+
+        async def run():
+            consumer.outbox = Outbox(send_json, maxsize=5, presence_delay=1)
+            for i in range(messages):
+                await consumer.chat_message({"type": "chat_message", "message": str(i)})
+                await asyncio.sleep(0)
+                if acknowledge and sent:
+                    await consumer.receive_json({"type": "ack", "seq": sent[-1]["seq"]})
+            consumer.outbox.close()
+
+        async_to_sync(run)()
+        return sent
+
+    def slow_consumer(self):
+        consumer = ChatConsumer()
+        consumer.scope = {"user": models.User(email="user@a.com")}
+        consumer.order_id = 1
+        consumer.close = mock.AsyncMock()
+        return consumer
+
+    def test_consumers_that_do_not_acknowledge_are_closed(self):
+        consumer = self.slow_consumer()
+        with self.assertLogs("main.consumers", level="WARNING"):
+            sent = self.flood(consumer, 10, acknowledge=False)
+
+        self.assertEqual([frame["seq"] for frame in sent], [1, 2, 3, 4, 5])
+        self.assertTrue(consumer.outbox.closed)
+        consumer.close.assert_awaited_once_with(code=ChatConsumer.SLOW_CONSUMER)
+
+    def test_consumers_that_acknowledge_are_kept(self):
+        consumer = self.slow_consumer()
+        sent = self.flood(consumer, 20, acknowledge=True)
+
+        self.assertEqual(len(sent), 20)
+        consumer.close.assert_not_awaited()
+
+
+class TestChatAuthorization(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer = models.User.objects.create_user("user@a.com", "pw432joij")
+        self.order = models.Order.objects.create(user=self.customer)
+        self.consumer = ChatConsumer()
+
+    def test_customer_is_authorized_with_one_query_then_from_cache(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.consumer.get_user_type(self.customer, self.order.id), ChatConsumer.CLIENT)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.consumer.get_user_type(self.customer, self.order.id), ChatConsumer.CLIENT)
+
+    def test_employee_connection_does_not_write(self):
+        employee = models.User.objects.create_user("employee@a.com", "pw432joij", is_staff=True)
+        employee.groups.add(Group.objects.create(name="Employees"))
+        with self.assertNumQueries(2) as ctx:
+            self.assertEqual(self.consumer.get_user_type(employee, self.order.id), ChatConsumer.EMPLOYEE)
+        self.assertTrue(all(q["sql"].startswith("SELECT") for q in ctx.captured_queries))
+
+    def test_other_customers_and_missing_orders_are_refused(self):
+        other = models.User.objects.create_user("other@a.com", "pw432joij")
+        self.assertIsNone(self.consumer.get_user_type(other, self.order.id))
+        self.assertIsNone(self.consumer.get_user_type(self.customer, self.order.id + 1))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.consumer.get_user_type(other, self.order.id))
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class TestChatRouting(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(chat_history._pending.clear)
+        for patcher in (
+            mock.patch("main.redis_pool.get_redis", mock.AsyncMock(return_value=FakeSortedSets())),
+            mock.patch("main.assignment._store", assignment.LocalAssignmentStore()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.customer = models.User.objects.create_user("user@a.com", "pw432joij", first_name="John")
+        self.order = models.Order.objects.create(user=self.customer)
+
+    def communicator(self, user=None):
+        from booktime.routing import application
+
+        headers = [(b"origin", b"http://testserver")]
+        if user is not None:
+            client = Client()
+            client.force_login(user)
+            headers.append((b"cookie", ("sessionid=%s" % client.cookies["sessionid"].value).encode()))
+        return WebsocketCommunicator(application, "/ws/customer-service/%d/" % self.order.id, headers=headers)
+
+    def test_customer_joins_and_messages_reach_the_employee(self):
+        employee = models.User.objects.create_superuser("admin@a.com", "pw432joij", first_name="Jane")
+        customer, agent = self.communicator(self.customer), self.communicator(employee)
+
+        async def chat():
+            self.assertTrue((await customer.connect())[0])
+            self.assertEqual((await customer.receive_json_from())["type"], "chat_history")
+            self.assertTrue((await agent.connect())[0])
+            self.assertEqual((await agent.receive_json_from())["type"], "chat_history")
+            await customer.send_json_to({"type": "message", "message": "where is my book?"})
+            received = await agent.receive_json_from()
+            presence = await agent.receive_json_from()
+            await customer.disconnect()
+            await agent.disconnect()
+            return received, presence
+
+        accepted = metrics.chat_connects.value(outcome="accepted")
+        group_sends = metrics.chat_group_send_seconds.count()
+        received, presence = async_to_sync(chat)()
+        self.assertEqual(metrics.chat_connects.value(outcome="accepted") - accepted, 2)
+        # Two joins, one message, two leaves
+        self.assertEqual(metrics.chat_group_send_seconds.count() - group_sends, 5)
+        self.assertNotIn('room="%d"' % self.order.id, metrics.chat_room_messages.render())
+        self.assertEqual(presence, {"type": "chat_presence", "joined": ["Jane"], "left": [], "seq": 2})
+        self.assertEqual(received["seq"], 1)
+        self.assertEqual(received["type"], "chat_message")
+        self.assertEqual(received["username"], "John")
+        self.assertEqual(received["message"], "where is my book?")
+
+    def test_anonymous_and_foreign_origin_connections_are_refused(self):
+        anonymous = self.communicator()
+        foreign = self.communicator(self.customer)
+        foreign.scope["headers"] = [
+            (b"origin", b"http://evil.example") if name == b"origin" else (name, value)
+            for name, value in foreign.scope["headers"]
+        ]
+
+        async def connect():
+            return (await anonymous.connect())[0], (await foreign.connect())[0]
+
+        self.assertEqual(async_to_sync(connect)(), (False, False))
+
+
+class TestAssignment(TestCase):
+    def test_chats_go_to_the_least_loaded_employee_and_wait_when_all_are_full(self):
+        store = assignment.LocalAssignmentStore()
+
+        async def run():
+            assigned = [await store.assign(room, ["a", "b"], 2, room) for room in ("1", "2", "3", "4", "5", "6")]
+            released = [await store.release("1"), await store.release("3"), await store.release("2")]
+            drained = await store.drain("c", 2)
+            return assigned, released, drained
+
+        assigned, released, drained = async_to_sync(run)()
+        self.assertEqual(assigned, ["a", "b", "a", "b", None, None])
+        # Freed slots go to the chat that waited longest
+        self.assertEqual(released, [("a", "5"), ("a", "6"), ("b", None)])
+        self.assertEqual(drained, [])
+        self.assertEqual(store.load, {"a": 2, "b": 1})
+
+    def test_customer_sockets_are_counted_in_the_shared_store(self):
+        store = assignment.LocalAssignmentStore(online=["a"])
+        patches = {
+            "_store": store,
+            "notify": mock.AsyncMock(),
+            "request_employee": mock.AsyncMock(wraps=assignment.request_employee),
+            "release_employee": mock.AsyncMock(wraps=assignment.release_employee),
+        }
+        with mock.patch.multiple("main.assignment", **patches):
+            async def run():
+                # Two workers each open and then close a socket of the same chat
+                for _ in range(2):
+                    await assignment.customer_connected(7)
+                assigned = dict(store.rooms)
+                for _ in range(2):
+                    await assignment.customer_disconnected(7)
+                return assigned
+
+            assigned = async_to_sync(run)()
+
+        self.assertEqual(assigned, {"7": "a"})
+        self.assertEqual(patches["request_employee"].await_count, 1)
+        self.assertEqual(patches["release_employee"].await_count, 1)
+        self.assertEqual((store.rooms, store.customers), ({}, {}))
+
+    def test_chats_of_an_employee_going_offline_go_to_the_others(self):
+        store = assignment.LocalAssignmentStore(online=["a", "b"])
+        notify = mock.AsyncMock()
+        with mock.patch.multiple("main.assignment", _store=store, notify=notify):
+            async def run():
+                for room in ("1", "2", "3"):
+                    await assignment.request_employee(room)
+                store.online = ["b"]
+                await assignment.employee_offline("a")
+
+            async_to_sync(run)()
+
+        self.assertEqual(store.rooms, {"1": "b", "2": "b", "3": "b"})
+        self.assertEqual(store.load, {"b": 3})
+        self.assertEqual(notify.await_args_list[-2:], [mock.call("b", "1"), mock.call("b", "3")])
+
+    def test_chats_left_behind_by_a_dead_worker_are_dropped(self):
+        redis = FakeSortedSets()
+        store = assignment.LocalAssignmentStore(online=["a"])
+        with mock.patch("main.redis_pool.get_redis", mock.AsyncMock(return_value=redis)), \
+                mock.patch.multiple("main.assignment", _store=store, notify=mock.AsyncMock()), \
+                self.settings(CHAT_PRESENCE_TIMEOUT=10, CHAT_ASSIGNMENT_MAX_ROOMS=1):
+            async def run():
+                await store.customer_joined("1", 100)
+                await assignment.request_employee("1")
+                await store.customer_joined("2", 100)
+                await assignment.request_employee("2")
+                # Only the waiting chat's customer is still sending heartbeats
+                redis._zadd(presence.room_key(assignment.chat_group("2")), 115, "user@a.com")
+                await store.customer_joined("3", 115)
+                await assignment.request_employee("3")
+                await assignment.drop_abandoned_chats(now=120)
+
+            async_to_sync(run)()
+
+        # The chat that opened just now is kept until its first heartbeat
+        self.assertEqual(store.rooms, {"2": "a"})
+        self.assertEqual(list(store.waiting), ["3"])
+        self.assertEqual(store.customers, {"2": 1, "3": 1})
+
+    @override_settings(
+        CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+        CHAT_ASSIGNMENT_MAX_ROOMS=1,
+    )
+    def test_employees_are_told_about_assigned_and_waiting_chats(self):
+        from booktime.routing import application
+
+        cache.clear()
+        self.addCleanup(chat_history._pending.clear)
+        self.addCleanup(presence._pending.clear)
+        redis = FakeSortedSets()
+        for patcher in (
+            mock.patch("main.redis_pool.get_redis", mock.AsyncMock(return_value=redis)),
+            mock.patch("main.assignment._store", assignment.LocalAssignmentStore()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        def communicator(user, path):
+            client = Client()
+            client.force_login(user)
+            return WebsocketCommunicator(application, path, headers=[
+                (b"origin", b"http://testserver"),
+                (b"cookie", ("sessionid=%s" % client.cookies["sessionid"].value).encode()),
+            ])
+
+        employee = models.User.objects.create_superuser("admin@a.com", "pw432joij")
+        orders = [
+            models.Order.objects.create(user=models.User.objects.create_user("user%d@a.com" % i, "pw432joij"))
+            for i in range(2)
+        ]
+        lobby = communicator(employee, "/ws/customer-service/assignments/")
+        first, second = (communicator(order.user, "/ws/customer-service/%d/" % order.id) for order in orders)
+
+        async def chat():
+            self.assertTrue((await lobby.connect())[0])
+            self.assertTrue((await first.connect())[0])
+            notified = [await lobby.receive_json_from()]
+            self.assertTrue((await second.connect())[0])
+            self.assertTrue(await lobby.receive_nothing())
+            await first.disconnect()
+            notified.append(await lobby.receive_json_from())
+            await second.disconnect()
+            await lobby.disconnect()
+            return notified
+
+        notified = async_to_sync(chat)()
+        self.assertEqual([event["order_id"] for event in notified], [orders[0].id, orders[1].id])
+        self.assertEqual(notified[1]["url"], reverse("cs_chat", kwargs={"order_id": orders[1].id}))
+        self.assertEqual(redis.sets[presence.room_key(assignment.LOBBY)], {})
+
+    @override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+    def test_customers_cannot_join_the_lobby(self):
+        from booktime.routing import application
+
+        customer = models.User.objects.create_user("user@a.com", "pw432joij")
+        self.client.force_login(customer)
+        lobby = WebsocketCommunicator(application, "/ws/customer-service/assignments/", headers=[
+            (b"origin", b"http://testserver"),
+            (b"cookie", ("sessionid=%s" % self.client.cookies["sessionid"].value).encode()),
+        ])
+        self.assertFalse(async_to_sync(lobby.connect)()[0])
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class TestOrderDashboard(TestCase):
+    def setUp(self):
+        self.customer = models.User.objects.create_user("user@a.com", "pw432joij")
+        self.product = models.Product.objects.create(name="A book", price=Decimal("10.00"))
+
+    def published(self, change):
+        with mock.patch("main.dashboard.publish") as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+        return [update for call in publish.call_args_list for update in call.args[0]]
+
+    def test_creations_and_status_changes_are_published_on_commit(self):
+        updates = self.published(lambda: models.Order.objects.create(user=self.customer))
+        self.assertEqual([(u["model"], u["created"]) for u in updates], [("order", True)])
+
+        def pay():
+            order = models.Order.objects.get()
+            order.status = models.Order.PAID
+            order.save()
+
+        updates = self.published(pay)
+        self.assertEqual([(u["status_display"], u["created"]) for u in updates], [("Paid", False)])
+
+    def test_saves_without_status_change_are_not_published(self):
+        models.Order.objects.create(user=self.customer)
+
+        def rename():
+            order = models.Order.objects.get()
+            order.shipping_name = "John"
+            order.save()
+
+        self.assertEqual(self.published(rename), [])
+
+    def test_bulk_status_changes_are_published_together(self):
+        order = models.Order.objects.create(user=self.customer, status=models.Order.PAID)
+        for _ in range(3):
+            models.OrderLine.objects.create(order=order, product=self.product)
+
+        with mock.patch("main.dashboard.publish") as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                models.OrderLine.objects.all().set_status(models.OrderLine.SENT)
+
+        line_updates = [c.args[0] for c in publish.call_args_list if c.args[0][0]["model"] == "orderline"]
+        self.assertEqual(len(line_updates), 1)
+        self.assertEqual({u["order"] for u in line_updates[0]}, {order.id})
+        self.assertEqual(len(line_updates[0]), 3)
+
+    def test_staff_dashboards_receive_updates(self):
+        from booktime.routing import application
+
+        staff = models.User.objects.create_user("staff@a.com", "pw432joij", is_staff=True)
+        sockets = []
+        for user in (staff, self.customer):
+            client = Client()
+            client.force_login(user)
+            sockets.append(WebsocketCommunicator(application, "/ws/order-dashboard/", headers=[
+                (b"origin", b"http://testserver"),
+                (b"cookie", ("sessionid=%s" % client.cookies["sessionid"].value).encode()),
+            ]))
+        dashboard_socket, customer_socket = sockets
+
+        def create_order():
+            with self.captureOnCommitCallbacks(execute=True):
+                return models.Order.objects.create(user=self.customer)
+
+        async def subscribe_and_order():
+            connected = (await dashboard_socket.connect())[0], (await customer_socket.connect())[0]
+            order = await database_sync_to_async(create_order)()
+            event = await dashboard_socket.receive_json_from()
+            await dashboard_socket.disconnect()
+            return connected, order, event
+
+        connected, order, event = async_to_sync(subscribe_and_order)()
+        self.assertEqual(connected, (True, False))
+        self.assertEqual(event["type"], "order.updates")
+        self.assertEqual(event["updates"][0]["id"], order.id)
+
+
+class TestRedisPool(TestCase):
+    def setUp(self):
+        redis_pool._pools.clear()
+
+    def test_consumers_share_one_pool_per_loop(self):
+        create = mock.AsyncMock(side_effect=lambda *args, **kwargs: FakeRedis())
+
+        async def connect_many():
+            return await asyncio.gather(*(redis_pool.get_redis() for _ in range(50)))
+
+        with mock.patch("aioredis.create_redis_pool", create):
+            clients = async_to_sync(connect_many)()
+
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual(create.call_args.args, ("redis://localhost",))
+        self.assertEqual(len({id(client) for client in clients}), 1)
+
+    def test_closed_pool_is_replaced(self):
+        create = mock.AsyncMock(side_effect=lambda *args, **kwargs: FakeRedis())
+
+        async def reconnect():
+            first = await redis_pool.get_redis()
+            first.closed = True
+            return first, await redis_pool.get_redis()
+
+        with mock.patch("aioredis.create_redis_pool", create):
+            first, second = async_to_sync(reconnect)()
+
+        self.assertIsNot(first, second)
+        self.assertEqual(create.call_count, 2)
+
+    def test_pool_is_closed_on_lifespan_shutdown(self):
+        from booktime.routing import application
+
+        messages = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+        sent = []
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        with mock.patch("main.redis_pool.close_pool") as close_pool:
+            async_to_sync(application)({"type": "lifespan"}, receive, send)
+
+        close_pool.assert_awaited_once_with()
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+
+    def test_consumers_collected_unclosed_are_counted_as_leaked(self):
+        before = redis_pool.pool_stats()
+
+        class Owner:
+            pass
+
+        closed_owner, leaked_owner = Owner(), Owner()
+        closed = redis_pool.ConsumerLifetime(closed_owner)
+        redis_pool.ConsumerLifetime(leaked_owner)
+        closed.close()
+        closed.close()
+        with self.assertLogs("main.redis_pool", level="WARNING"):
+            del leaked_owner
+            gc.collect()
+
+        after = redis_pool.pool_stats()
+        self.assertTrue(closed.closed)
+        self.assertEqual(after["consumers_opened"] - before["consumers_opened"], 2)
+        self.assertEqual(after["consumers_closed"] - before["consumers_closed"], 1)
+        self.assertEqual(after["consumers_leaked"] - before["consumers_leaked"], 1)
+        self.assertEqual(after["consumers_open"], before["consumers_open"])
+
+    def test_stats_are_admin_only(self):
+        user = models.User.objects.create_user("user@a.com", "pw432joij")
+        self.client.force_login(user)
+        response = self.client.get(reverse("chat_redis_stats"))
+        self.assertEqual(response.status_code, 403)
+
+        admin = models.User.objects.create_superuser("admin@a.com", "pw432joij")
+        self.client.force_login(admin)
+        response = self.client.get(reverse("chat_redis_stats"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["pools"], 0)
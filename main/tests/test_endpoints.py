@@ -0,0 +1,475 @@
+import csv
+import json
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.testing import HttpCommunicator
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import serializers
+
+from main import endpoints, factories, models
+
+
+class TestEndpoints(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = models.User.objects.create_superuser("admin@site.com", "pw432joij")
+        self.client.force_login(self.user)
+
+    def create_paid_orders(self, count, lines_per_order=2):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(count):
+                order = factories.OrderFactory(status=models.Order.PAID)
+                for j in range(lines_per_order):
+                    product = factories.ProductFactory(name="Product %d-%d" % (i, j))
+                    factories.OrderLineFactory(order=order, product=product)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_orderlines_query_count_does_not_grow_with_page_size(self):
+        self.create_paid_orders(1)
+        small, response = self.count_queries(reverse("orderline-list"))
+        self.assertEqual(len(response.json()["results"]), 2)
+
+        self.create_paid_orders(20)
+        large, response = self.count_queries(reverse("orderline-list"))
+        self.assertEqual(len(response.json()["results"]), 42)
+        self.assertEqual(small, large)
+
+    def test_orders_query_count_does_not_grow_with_page_size(self):
+        self.create_paid_orders(1)
+        small, response = self.count_queries(reverse("order-list"))
+        self.assertEqual(len(response.json()["results"]), 1)
+
+        self.create_paid_orders(20)
+        large, response = self.count_queries(reverse("order-list"))
+        self.assertEqual(len(response.json()["results"]), 21)
+        self.assertEqual(small, large)
+
+    def test_orderlines_render_product_name_and_order_link(self):
+        self.create_paid_orders(1, lines_per_order=1)
+        response = self.client.get(reverse("orderline-list"))
+        line = response.json()["results"][0]
+        order = models.Order.objects.get()
+
+        self.assertEqual(line["product"], "Product 0-0")
+        self.assertTrue(line["order"].endswith(reverse("order-detail", args=[order.id])))
+
+    def test_orders_are_cursor_paginated_without_count(self):
+        self.create_paid_orders(3)
+        response = self.client.get(reverse("order-list"), {"page_size": 2})
+        data = response.json()
+
+        self.assertNotIn("count", data)
+        self.assertEqual(len(data["results"]), 2)
+        self.assertIsNotNone(data["next"])
+
+    def test_orders_cursor_is_stable_while_rows_are_inserted(self):
+        self.create_paid_orders(3)
+        expected = [o.date_updated for o in models.Order.objects.order_by("-date_added", "id")]
+
+        first = self.client.get(reverse("order-list"), {"page_size": 2}).json()
+        self.create_paid_orders(2)
+        second = self.client.get(first["next"]).json()
+
+        seen = [o["date_updated"] for o in first["results"] + second["results"]]
+        self.assertEqual(seen, [serializers.DateTimeField().to_representation(d) for d in expected])
+        self.assertIsNone(second["next"])
+
+    def test_orderlines_cursor_is_stable_while_rows_are_inserted(self):
+        self.create_paid_orders(3)
+        expected = list(models.OrderLine.objects.order_by("-order__date_added", "id").values_list("id", flat=True))
+
+        first = self.client.get(reverse("orderline-list"), {"page_size": 4}).json()
+        self.create_paid_orders(2)
+        second = self.client.get(first["next"]).json()
+
+        seen = [line["id"] for line in first["results"] + second["results"]]
+        self.assertEqual(seen, expected)
+        self.assertIsNone(second["next"])
+
+    def test_bulk_status_updates_lines_and_completes_orders(self):
+        self.create_paid_orders(2)
+        first, second = models.Order.objects.order_by("id")
+        ids = list(first.lines.values_list("id", flat=True)) + [second.lines.first().id]
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse("orderline-bulk-status"),
+                                        {"ids": ids, "status": models.OrderLine.SENT},
+                                        content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response.json()["ids"]), sorted(ids))
+        self.assertLess(len(ctx.captured_queries), 15)
+        self.assertEqual(models.OrderLine.objects.filter(status=models.OrderLine.SENT).count(), 3)
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.status, models.Order.DONE)
+        self.assertEqual(second.status, models.Order.PAID)
+
+    def test_bulk_status_skips_lines_already_in_target_status(self):
+        self.create_paid_orders(1)
+        line, other = models.OrderLine.objects.order_by("id")
+        models.OrderLine.objects.filter(id=line.id).update(status=models.OrderLine.PROCESSING)
+
+        response = self.client.post(reverse("orderline-bulk-status"),
+                                    {"ids": [line.id, other.id], "status": models.OrderLine.PROCESSING},
+                                    content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["ids"], [other.id])
+
+    def test_bulk_status_rejects_invalid_transitions(self):
+        self.create_paid_orders(1)
+        line, other = models.OrderLine.objects.order_by("id")
+        models.OrderLine.objects.filter(id=line.id).update(status=models.OrderLine.SENT)
+
+        response = self.client.post(reverse("orderline-bulk-status"),
+                                    {"ids": [line.id, other.id], "status": models.OrderLine.PROCESSING},
+                                    content_type="application/json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("status", response.json())
+        self.assertEqual(models.OrderLine.objects.get(id=other.id).status, models.OrderLine.NEW)
+
+    def test_bulk_status_rejects_unknown_lines(self):
+        response = self.client.post(reverse("orderline-bulk-status"),
+                                    {"ids": [1234], "status": models.OrderLine.SENT},
+                                    content_type="application/json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("ids", response.json())
+
+    def test_updated_since_returns_only_changed_rows(self):
+        self.create_paid_orders(2)
+        old, changed = models.Order.objects.order_by("id")
+        since = timezone.now() + timedelta(seconds=1)
+        models.Order.objects.filter(id=old.id).update(date_updated=since - timedelta(days=1))
+        models.OrderLine.objects.filter(order=old).update(date_updated=since - timedelta(days=1))
+        models.Order.objects.filter(id=changed.id).update(date_updated=since)
+        models.OrderLine.objects.filter(order=changed).update(date_updated=since)
+
+        token = since.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        orders = self.client.get(reverse("order-list"), {"updated_since": token}).json()
+        lines = self.client.get(reverse("orderline-list"), {"updated_since": token}).json()
+
+        self.assertEqual([o["id"] for o in orders["results"]], [changed.id])
+        self.assertEqual({line["order"].rstrip("/").rsplit("/", 1)[1] for line in lines["results"]},
+                         {str(changed.id)})
+
+    def test_updated_since_includes_orders_that_left_the_paid_set(self):
+        self.create_paid_orders(1)
+        since = self.client.get(reverse("api_sync")).json()["token"]
+        order = models.Order.objects.get()
+        self.client.post(reverse("orderline-bulk-status"),
+                         {"ids": list(order.lines.values_list("id", flat=True)),
+                          "status": models.OrderLine.SENT},
+                         content_type="application/json")
+
+        self.assertEqual(self.client.get(reverse("order-list")).json()["results"], [])
+        orders = self.client.get(reverse("order-list"), {"updated_since": since}).json()["results"]
+        lines = self.client.get(reverse("orderline-list"), {"updated_since": since}).json()["results"]
+
+        self.assertEqual([(o["id"], o["status"]) for o in orders], [(order.id, models.Order.DONE)])
+        self.assertEqual({line["status"] for line in lines}, {models.OrderLine.SENT})
+
+    def test_updated_since_includes_lines_of_orders_that_became_paid(self):
+        order = factories.OrderFactory(status=models.Order.NEW)
+        factories.OrderLineFactory.create_batch(2, order=order, product=factories.ProductFactory())
+        models.OrderLine.objects.update(date_updated=timezone.now() - timedelta(days=1))
+        since = (timezone.now() - timedelta(seconds=1)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+        order.status = models.Order.PAID
+        order.save()
+
+        lines = self.client.get(reverse("orderline-list"), {"updated_since": since}).json()["results"]
+        self.assertEqual({line["id"] for line in lines}, set(order.lines.values_list("id", flat=True)))
+
+    def test_sync_reports_deleted_rows_and_monotonic_token(self):
+        self.create_paid_orders(2)
+        first = self.client.get(reverse("api_sync")).json()
+        self.assertEqual(first["deleted"], {"orders": [], "orderlines": []})
+
+        since = (timezone.now() - timedelta(seconds=1)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        order = models.Order.objects.order_by("id").first()
+        order_id = order.id
+        line_ids = list(order.lines.values_list("id", flat=True))
+        order.delete()
+
+        data = self.client.get(reverse("api_sync"), {"since": since}).json()
+        self.assertEqual(data["deleted"]["orders"], [order_id])
+        self.assertEqual(sorted(data["deleted"]["orderlines"]), sorted(line_ids))
+        self.assertGreaterEqual(data["token"], since)
+
+    def test_sync_rejects_invalid_token(self):
+        response = self.client.get(reverse("api_sync"), {"since": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_streams_ndjson(self):
+        self.create_paid_orders(3)
+        factories.OrderFactory(status=models.Order.NEW)
+
+        response = self.client.get(reverse("order-export"), HTTP_ACCEPT="application/x-ndjson")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        paid = models.Order.objects.filter(status=models.Order.PAID).order_by("-date_added", "id")
+        self.assertEqual([row["id"] for row in rows], [order.id for order in paid])
+        self.assertEqual(rows[0]["user__email"], "user@site.com")
+
+    def test_export_streams_csv_with_order_filters(self):
+        self.create_paid_orders(2)
+        order = models.Order.objects.order_by("id").first()
+        order.shipping_city = "London"
+        order.user = factories.UserFactory(email="finance@site.com")
+        order.save()
+
+        response = self.client.get(reverse("order-export"), {"format": "csv", "user__email__icontains": "finance"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
+        rows = list(csv.DictReader(b"".join(response.streaming_content).decode("utf8").splitlines()))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["id"], str(order.id))
+        self.assertEqual(rows[0]["shipping_city"], "London")
+
+    def test_export_is_refused_to_customers(self):
+        self.create_paid_orders(1)
+        self.client.force_login(factories.UserFactory(email="customer@site.com"))
+
+        response = self.client.get(reverse("order-export"), {"format": "csv"})
+
+        self.assertEqual(response.status_code, 403)
+
+    def test_sparse_fieldset_narrows_output_and_select(self):
+        self.create_paid_orders(2)
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("order-list"), {"fields": "id,status"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({tuple(sorted(o)) for o in response.json()["results"]}, {("id", "status")})
+        select = [q["sql"] for q in ctx.captured_queries
+                  if '"main_order"' in q["sql"] and "COUNT" not in q["sql"]]
+        self.assertEqual(len(select), 1)
+        self.assertNotIn("shipping_name", select[0])
+
+    def test_sparse_fieldset_on_orderlines_joins_only_what_is_needed(self):
+        self.create_paid_orders(3)
+
+        product, _ = self.count_queries(reverse("orderline-list") + "?fields=id,product")
+        plain, response = self.count_queries(reverse("orderline-list") + "?fields=id,status")
+
+        self.assertEqual(product, plain)
+        self.assertEqual({tuple(sorted(line)) for line in response.json()["results"]}, {("id", "status")})
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse("orderline-list"), {"fields": "id,status"})
+        select = [q["sql"] for q in ctx.captured_queries
+                  if '"main_orderline"' in q["sql"] and "COUNT" not in q["sql"]]
+        self.assertNotIn("main_product", select[0])
+        self.assertNotIn("shipping_name", select[0])
+        data = self.client.get(reverse("orderline-list"), {"fields": "id,product"}).json()
+        self.assertTrue(all(line["product"].startswith("Product") for line in data["results"]))
+
+    def test_orders_render_as_msgpack(self):
+        self.create_paid_orders(1)
+
+        response = self.client.get(reverse("order-list"), {"fields": "id"}, HTTP_ACCEPT="application/msgpack")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/msgpack")
+        data = msgpack.unpackb(response.content)
+        self.assertEqual(data["results"], [{"id": models.Order.objects.get().id}])
+
+    def test_orders_list_returns_not_modified_for_matching_etag(self):
+        self.create_paid_orders(2)
+        response = self.client.get(reverse("order-list"))
+        etag = response["ETag"]
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("order-list"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertFalse([q for q in ctx.captured_queries if "shipping_name" in q["sql"]])
+
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("order-list"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len([q for q in ctx.captured_queries if "COUNT" in q["sql"]]), 1)
+        self.assertFalse([q for q in ctx.captured_queries if "shipping_name" in q["sql"]])
+
+        order = models.Order.objects.first()
+        order.shipping_city = "Paris"
+        order.save()
+        response = self.client.get(reverse("order-list"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_orderlines_etag_changes_when_a_line_leaves_the_list(self):
+        self.create_paid_orders(2)
+        etag = self.client.get(reverse("orderline-list"))["ETag"]
+        detail = reverse("orderline-detail", args=[models.OrderLine.objects.first().id])
+        detail_etag = self.client.get(detail)["ETag"]
+
+        self.assertEqual(self.client.get(detail, HTTP_IF_NONE_MATCH=detail_etag).status_code, 304)
+        self.assertEqual(self.client.get(reverse("orderline-list"), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        order = models.Order.objects.last()
+        order.status = models.Order.DONE
+        with self.captureOnCommitCallbacks(execute=True):
+            order.save()
+        response = self.client.get(reverse("orderline-list"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["results"]), 2)
+
+    def test_etag_depends_on_requested_fields(self):
+        self.create_paid_orders(1)
+        etag = self.client.get(reverse("order-list"))["ETag"]
+
+        response = self.client.get(reverse("order-list"), {"fields": "id"}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_list_responses_are_cached_until_an_order_changes(self):
+        self.create_paid_orders(2)
+        response = self.client.get(reverse("order-list"), {"fields": "id,status"})
+        self.assertEqual(response["X-Cache"], "MISS")
+
+        with CaptureQueriesContext(connection) as ctx:
+            cached = self.client.get(reverse("order-list"), {"status": "20", "fields": "id,status"})
+            cached = self.client.get(reverse("order-list"), {"fields": "id,status"})
+        self.assertEqual(cached["X-Cache"], "HIT")
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(len([q for q in ctx.captured_queries if "main_order" in q["sql"]]), 2)
+
+        order = models.Order.objects.first()
+        order.shipping_city = "Paris"
+        with self.captureOnCommitCallbacks(execute=True):
+            order.save()
+        self.assertEqual(self.client.get(reverse("order-list"), {"fields": "id,status"})["X-Cache"], "MISS")
+
+    def test_cached_list_honours_if_none_match(self):
+        self.create_paid_orders(1)
+        etag = self.client.get(reverse("orderline-list"))["ETag"]
+
+        response = self.client.get(reverse("orderline-list"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["X-Cache"], "HIT")
+
+    def test_bulk_status_invalidates_cached_lists(self):
+        self.create_paid_orders(1)
+        self.client.get(reverse("orderline-list"))
+        line = models.OrderLine.objects.first()
+
+        self.client.post(reverse("orderline-bulk-status"),
+                         {"ids": [line.id], "status": models.OrderLine.PROCESSING},
+                         content_type="application/json")
+
+        response = self.client.get(reverse("orderline-list"))
+        self.assertEqual(response["X-Cache"], "MISS")
+        statuses = {item["id"]: item["status"] for item in response.json()["results"]}
+        self.assertEqual(statuses[line.id], models.OrderLine.PROCESSING)
+
+    def test_product_rename_invalidates_cached_lines(self):
+        self.create_paid_orders(1, lines_per_order=1)
+        self.client.get(reverse("orderline-list"))
+
+        product = models.Product.objects.get()
+        product.name = "Renamed"
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+
+        response = self.client.get(reverse("orderline-list"))
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(response.json()["results"][0]["product"], "Renamed")
+
+    def test_invalidation_waits_for_commit_and_survives_a_cache_outage(self):
+        product = factories.ProductFactory()
+        version = endpoints.get_api_cache_version()
+        with self.captureOnCommitCallbacks() as callbacks:
+            product.name = "Renamed"
+            product.save()
+        self.assertEqual(endpoints.get_api_cache_version(), version)
+
+        with mock.patch("main.endpoints.cache.incr", side_effect=ConnectionError("Cache down")), \
+                self.assertLogs("main.endpoints", "WARNING"):
+            for callback in callbacks:
+                callback()
+        self.assertEqual(endpoints.get_api_cache_version(), version)
+
+    def test_invalidation_reaches_every_client_of_a_shared_cache(self):
+        with tempfile.TemporaryDirectory() as location, self.settings(CACHES={"default": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": location}}):
+            # One client per worker process, sharing the cache's storage
+            worker, other = caches.create_connection("default"), caches.create_connection("default")
+            with mock.patch("main.endpoints.cache", other):
+                version = endpoints.get_api_cache_version()
+            with mock.patch("main.endpoints.cache", worker):
+                endpoints.invalidate_api_cache()
+            with mock.patch("main.endpoints.cache", other):
+                self.assertNotEqual(endpoints.get_api_cache_version(), version)
+
+    def test_cache_stats_report_hits_and_misses(self):
+        self.client.get(reverse("order-list"))
+        self.client.get(reverse("order-list"))
+
+        stats = self.client.get(reverse("api_cache_stats")).json()
+        self.assertEqual(stats, {"hits": 1, "misses": 1, "hit_ratio": 0.5})
+
+    def test_async_lists_match_sync_lists(self):
+        self.create_paid_orders(3)
+
+        for name in ("order-list", "orderline-list"):
+            expected = self.client.get(reverse(name), {"page_size": 2}).json()
+            response = self.client.get(reverse(name + "-async"), {"page_size": 2})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["results"], expected["results"])
+            self.assertEqual(response.json()["next"].replace(reverse(name + "-async"), reverse(name)),
+                             expected["next"])
+
+            expected = self.client.get(expected["next"]).json()
+            second = self.client.get(response.json()["next"])
+            self.assertEqual(second.json()["results"], expected["results"])
+
+    def test_async_lists_require_authentication(self):
+        self.client.logout()
+        response = self.client.get(reverse("order-list-async"))
+        self.assertEqual(response.status_code, 403)
+
+
+class TestASGIStreaming(TransactionTestCase):
+    """Streamed responses through the deployed ASGI application. The body
+    is read in another thread, so the rows it reads must be committed."""
+
+    def test_export_streams_through_the_asgi_application(self):
+        from booktime.routing import application
+
+        for i in range(3):
+            order = factories.OrderFactory(status=models.Order.PAID)
+            factories.OrderLineFactory(order=order, product=factories.ProductFactory(name="Product %d" % i))
+        self.client.force_login(models.User.objects.create_superuser("admin@site.com", "pw432joij"))
+        cookie = "%s=%s" % (settings.SESSION_COOKIE_NAME, self.client.cookies[settings.SESSION_COOKIE_NAME].value)
+        communicator = HttpCommunicator(application, "GET", "/api/orders/export/?format=csv",
+                                        headers=[(b"host", b"testserver"), (b"cookie", cookie.encode())])
+
+        response = async_to_sync(communicator.get_response)()
+
+        self.assertEqual(response["status"], 200)
+        rows = list(csv.DictReader(response["body"].decode("utf8").splitlines()))
+        self.assertEqual(len(rows), 3)
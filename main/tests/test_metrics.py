@@ -0,0 +1,65 @@
+from django.test import TestCase
+from django.urls import reverse
+
+from main import metrics, models
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.registered = list(metrics.REGISTRY)
+        self.addCleanup(self.restore_registry)
+
+    def restore_registry(self):
+        metrics.REGISTRY[:] = self.registered
+
+    def test_counters_and_gauges_render_with_labels(self):
+        counter = metrics.Counter("test_frames_total", "Frames", ["type"])
+        counter.inc(type="message")
+        counter.inc(2, type="message")
+        counter.inc(type='say "hi"')
+        gauge = metrics.Gauge("test_sockets", "Sockets")
+        gauge.inc()
+        gauge.dec()
+        gauge.inc(3)
+
+        text = counter.render() + "\n" + gauge.render()
+        self.assertIn("# TYPE test_frames_total counter", text)
+        self.assertIn('test_frames_total{type="message"} 3', text)
+        self.assertIn('test_frames_total{type="say \\"hi\\""} 1', text)
+        self.assertIn("# TYPE test_sockets gauge", text)
+        self.assertIn("test_sockets 3", text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "Latency", buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value)
+
+        lines = histogram.render().splitlines()
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn("test_seconds_count 4", lines)
+        self.assertIn("test_seconds_sum 6.05", lines)
+
+    def test_removed_series_are_not_rendered(self):
+        counter = metrics.Counter("test_room_total", "Per room", ["room"])
+        counter.inc(room=1)
+        counter.inc(room=2)
+        counter.remove(room=1)
+        self.assertNotIn('room="1"', counter.render())
+        self.assertIn('test_room_total{room="2"} 1', counter.render())
+
+    def test_worker_metrics_are_for_internal_scrapers_and_staff(self):
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="127.0.0.1")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn(b"# TYPE booktime_chat_connections gauge", response.content)
+        self.assertIn(b"booktime_chat_leaked_consumers ", response.content)
+
+        staff = models.User.objects.create_user("staff@a.com", "pw432joij", is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, 200)
@@ -2,6 +2,7 @@ from decimal import Decimal
 from unittest.mock import patch
 
 from django.contrib import auth
+from django.contrib.auth.models import Group
 from django.test import TestCase
 from django.urls import reverse
 
@@ -63,6 +64,48 @@ class TestPage(TestCase):
 
         self.assertEqual(list(product_list), list(response.context['object_list']))
 
+    def test_async_products_page_matches_sync_page(self):
+        product = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        product.tags.create(name="Open source", slug="opensource")
+        models.Product.objects.create(
+            name="Microsoft Windows Guide",
+            slug="microsoft-windows-guide",
+            price=Decimal("12.00"),
+        )
+
+        response = self.client.get(reverse("products_async", kwargs={"tag": "opensource"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "The cathedral and the bazaar")
+        self.assertNotContains(response, "Microsoft Windows Guide")
+        self.assertEqual(list(response.context["object_list"]), [product])
+
+        response = self.client.get(reverse("products_async", kwargs={"tag": "all"}))
+        self.assertEqual(len(response.context["object_list"]), 2)
+
+        response = self.client.get(reverse("products_async", kwargs={"tag": "missing"}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_async_product_detail_page_works(self):
+        product = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        product.tags.create(name="Open source", slug="opensource")
+
+        with patch("webpack_loader.loader.WebpackLoader.get_bundle", return_value=[]):
+            response = self.client.get(reverse("product_async", kwargs={"slug": "cathedral-bazaar"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Open source")
+        self.assertEqual(response.context["object"], product)
+
+        response = self.client.get(reverse("product_async", kwargs={"slug": "missing"}))
+        self.assertEqual(response.status_code, 404)
+
     def test_user_signup_page_loads_correctly(self):
         response = self.client.get(reverse("signup"))
         self.assertEqual(response.status_code, 200)
@@ -171,3 +214,24 @@ class TestPage(TestCase):
         self.assertTrue(models.Basket.objects.filter(user=user_1).exists())
         basket = models.Basket.objects.get(user=user_1)
         self.assertEquals(basket.count(), 3)
+
+    def test_order_dashboard_tags_rows_for_live_updates(self):
+        staff = models.User.objects.create_user("staff@a.com", "pw432joij", is_staff=True)
+        for i in range(3):
+            customer = models.User.objects.create_user("user%d@a.com" % i, "pw432joij")
+            models.Order.objects.create(user=customer, status=models.Order.PAID)
+        self.client.force_login(staff)
+
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse("order_dashboard"))
+        self.assertEqual(response.status_code, 200)
+        for order in models.Order.objects.all():
+            self.assertContains(response, 'data-order="%d"' % order.id)
+        self.assertContains(response, 'data-field="status"', count=3)
+        self.assertContains(response, "/ws/order-dashboard/")
+        # Only employees take chats, so only they join the assignment lobby
+        self.assertNotContains(response, "/ws/customer-service/assignments/")
+
+        staff.groups.add(Group.objects.create(name="Employees"))
+        response = self.client.get(reverse("order_dashboard"))
+        self.assertContains(response, "/ws/customer-service/assignments/")
@@ -20,6 +20,8 @@ urlpatterns = [
     path("", TemplateView.as_view(template_name="home.html"), name="home"),
     path("products/<slug:tag>/", views.ProductListView.as_view(), name="products"),
     path("product/<slug:slug>/", DetailView.as_view(model=models.Product), name="product"),
+    path("async/products/<slug:tag>/", views.product_list_async, name="products_async"),
+    path("async/product/<slug:slug>/", views.product_detail_async, name="product_async"),
     path("signup/", views.SignupView.as_view(), name="signup"),
     path("login/", auth_views.LoginView.as_view(template_name="login.html",
                                                 form_class=forms.AuthenticationForm), name="login"),
@@ -28,6 +30,14 @@ urlpatterns = [
     path("order/done/", TemplateView.as_view(template_name="order_done.html"), name="checkout_done"),
     path("address-select/", views.AddressSelectionView.as_view(), name="address_select"),
     path("order-dashboard/", views.OrderView.as_view(), name="order_dashboard",),
+    path("api/async/orderlines/", endpoints.paid_orderlines_async, name="orderline-list-async"),
+    path("api/async/orders/", endpoints.paid_orders_async, name="order-list-async"),
+    path("api/sync/", endpoints.SyncView.as_view(), name="api_sync"),
+    path("api/cache-stats/", endpoints.APICacheStatsView.as_view(), name="api_cache_stats"),
+    path("api/orders/<int:order_id>/chat/", endpoints.ChatMessageListView.as_view(), name="chat_history"),
+    path("api/chat-presence/", endpoints.chat_presence, name="chat_presence"),
+    path("api/chat-redis-stats/", endpoints.ChatRedisStatsView.as_view(), name="chat_redis_stats"),
     path("api/", include(router.urls)),
+    path("metrics/", endpoints.worker_metrics, name="metrics"),
     path("customer-service/<int:order_id>/", views.room, name="cs_chat"),
 ]
@@ -1,12 +1,15 @@
 import logging
 
 import django_filters
+import django_tables2 as tables
+from asgiref.sync import sync_to_async
 from django import forms as django_forms
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.core.paginator import Paginator
 from django.db import models as django_models
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse, reverse_lazy
 from django.views.generic import FormView, ListView
@@ -44,12 +47,51 @@ class ProductListView(ListView):
             self.tag = get_object_or_404(models.ProductTag, slug=tag)
 
         if self.tag:
-            products = models.Product.objects.active().filter(tag=self.tag)
+            products = models.Product.objects.active().filter(tags=self.tag)
         else:
             products = models.Product.objects.active()
         return products.order_by("name")
 
 
+async def product_list_async(request, tag):
+    """ProductListView for ASGI workers: the rows are read with the async ORM
+    and only the template, which looks at the user and basket, is rendered
+    in a thread."""
+    products = models.Product.objects.active()
+    if tag != "all":
+        try:
+            product_tag = await models.ProductTag.objects.aget(slug=tag)
+        except models.ProductTag.DoesNotExist:
+            raise Http404("No product tag found matching the query")
+        products = products.filter(tags=product_tag)
+    products = products.order_by("name")
+
+    paginator = Paginator(products, ProductListView.paginate_by)
+    paginator.count = await products.acount()
+    page = paginator.get_page(request.GET.get("page"))
+    page.object_list = [product async for product in page.object_list]
+
+    context = {
+        "paginator": paginator,
+        "page_obj": page,
+        "is_paginated": page.has_other_pages(),
+        "object_list": page.object_list,
+        "product_list": page.object_list,
+    }
+    return await sync_to_async(render)(request, ProductListView.template_name, context)
+
+
+async def product_detail_async(request, slug):
+    queryset = models.Product.objects.prefetch_related("tags", "productimage_set")
+    try:
+        product = await queryset.aget(slug=slug)
+    except models.Product.DoesNotExist:
+        raise Http404("No product found matching the query")
+
+    context = {"object": product, "product": product}
+    return await sync_to_async(render)(request, "main/product_detail.html", context)
+
+
 class SignupView(FormView):
     template_name = "signup.html"
     form_class = forms.UserCreationForm
@@ -198,10 +240,28 @@ class OrderFilter(django_filters.FilterSet):
         }
 
 
+class OrderTable(tables.Table):
+    # Rows and cells are tagged so that live updates can patch them
+    status = tables.Column(attrs={"td": {"data-field": "status"}})
+    date_updated = tables.DateTimeColumn(attrs={"td": {"data-field": "date_updated"}})
+
+    class Meta:
+        model = models.Order
+        row_attrs = {"data-order": lambda record: record.pk}
+
+
 class OrderView(UserPassesTestMixin, FilterView):
     filterset_class = OrderFilter
+    queryset = models.Order.objects.select_related("user")
     login_url = reverse_lazy("login")
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["table"] = OrderTable(context["filter"].qs, request=self.request)
+        # Read once for the template; only employees are assigned chats
+        context["is_employee"] = self.request.user.is_employee
+        return context
+
     def test_func(self):
         return self.request.user.is_staff is True
 